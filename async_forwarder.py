@@ -0,0 +1,174 @@
+import asyncio
+import sys
+import port_forwarder
+
+# Port forwarder engine built on asyncio. It reads the same config file and port mapping as
+# port_forwarder.py, and can either be run on its own or embedded into another asyncio program
+# by awaiting start_servers().
+
+
+# Protocol for one side of a forwarded connection. Reads land directly in a preallocated buffer
+# and are written to the transport of the peer protocol. When the peer's transport has too much
+# data buffered, reading from this side is paused until it has drained.
+class RelayProtocol(asyncio.BufferedProtocol):
+
+    def __init__(self, read_size):
+        self.read_size = read_size
+        self.buffer = bytearray(read_size)
+        self.transport = None
+        self.peer = None
+        # Set once this side has sent everything it is going to send.
+        self.eof = False
+
+    # Joins two protocols together so that data read by one is written by the other.
+    def pair(self, peer):
+        self.peer = peer
+        peer.peer = self
+        for protocol in (self, peer):
+            protocol.transport.set_write_buffer_limits(high=port_forwarder.HIGH_WATERMARK,
+                                                       low=port_forwarder.LOW_WATERMARK)
+            protocol.transport.resume_reading()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Nothing is read until the connection has been paired with its peer.
+        transport.pause_reading()
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        data = memoryview(self.buffer)[:nbytes]
+        if data == b"quit\n":
+            self.transport.close()
+            return
+        peer_transport = self.peer.transport
+        peer_transport.write(data)
+        # If the peer could not send everything right away its transport may still refer to the
+        # buffer, so the next read goes into a new one.
+        if peer_transport.get_write_buffer_size():
+            self.buffer = bytearray(self.read_size)
+
+    # The end of the data is passed on to the peer and the other direction is still relayed, the pair is
+    # closed once both sides have finished.
+    def eof_received(self):
+        self.eof = True
+        if self.peer is None or self.peer.eof:
+            # Closing the transports lets them flush whatever data they are still holding.
+            if self.peer is not None:
+                self.peer.transport.close()
+            return False
+        # The peer's transport shuts down its sending side once its buffered data has been sent.
+        self.peer.transport.write_eof()
+        return True
+
+    def connection_lost(self, exc):
+        if self.peer is not None:
+            self.peer.transport.close()
+
+    # The peer's transport has too much data buffered, so stop reading from this side.
+    def pause_writing(self):
+        if self.peer is not None:
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer is not None:
+            self.peer.transport.resume_reading()
+
+
+# This coroutine connects an accepted external connection to the internal host chosen for the port mapping.
+async def connect_internal(external, port):
+    sock = external.transport.get_extra_info('socket')
+    backend = port_forwarder.choose_backend(port, sock.family)
+    if backend is None:
+        print(f"No internal host available for port {port}", file=sys.stderr)
+        external.transport.close()
+        return
+    external.backend = backend
+    internal_address = backend['address']
+    print(f"Establishing connection from {sock.getsockname()} to internal host {internal_address}")
+    loop = asyncio.get_running_loop()
+    read_size = port_forwarder.mapping_options[port]['read_size']
+    # A connect timeout of 0 means no timeout.
+    connect_timeout = port_forwarder.mapping_options[port]['connect_timeout'] or None
+    try:
+        transport, internal = await asyncio.wait_for(
+            loop.create_connection(lambda: RelayProtocol(read_size), *internal_address), connect_timeout)
+    except (OSError, asyncio.TimeoutError) as error:
+        print(f"Unable to connect to internal host {internal_address}: {error}", file=sys.stderr)
+        port_forwarder.record_failure(backend)
+        external.transport.close()
+        return
+    port_forwarder.record_success(backend)
+    if external.transport.is_closing():
+        transport.close()
+        return
+    external.pair(internal)
+
+
+# Protocol for connections accepted on a listening port, the connection to the internal host is
+# started as soon as the external connection is made.
+class ExternalProtocol(RelayProtocol):
+
+    def __init__(self, port):
+        super().__init__(port_forwarder.mapping_options[port]['read_size'])
+        self.port = port
+        self.connect_task = None
+        self.fd = None
+        # Backend the connection is forwarded to, released once the connection is lost.
+        self.backend = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        peername = transport.get_extra_info('peername')
+        self.fd = transport.get_extra_info('socket').fileno()
+        reason = port_forwarder.admit_connection(self.fd, self.port, peername[0])
+        if reason is not None:
+            print(f"Connection from external host {peername} to port {self.port} rejected by {reason}",
+                  file=sys.stderr)
+            port_forwarder.rejected_connections[(self.port, reason)] = \
+                port_forwarder.rejected_connections.get((self.port, reason), 0) + 1
+            transport.abort()
+            return
+        print(f"Connection established to {transport.get_extra_info('sockname')} "
+              f"from external host {peername}")
+        # Keep a reference to the task so that it is not garbage collected while it is running.
+        self.connect_task = asyncio.get_running_loop().create_task(connect_internal(self, self.port))
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        # The socket is closed after connection_lost() returns, so its descriptor has not been reused yet.
+        port_forwarder.release_client(self.fd)
+        if self.backend is not None:
+            port_forwarder.release_backend(self.backend)
+        print("Connection Closed")
+
+
+# This coroutine creates a listening server for every port mapping on both the IPv4 and IPv6
+# addresses of the port forwarder, and returns the list of servers.
+async def start_servers():
+    loop = asyncio.get_running_loop()
+    servers = []
+    for key in port_forwarder.port_mapping:
+        server = await loop.create_server(lambda port=key: ExternalProtocol(port),
+                                          host=[port_forwarder.server_host_ipv4, port_forwarder.server_host_ipv6],
+                                          port=key, backlog=10000)
+        servers.append(server)
+    return servers
+
+
+async def main():
+    servers = await start_servers()
+    print("Asyncio Port Forwarder Started")
+    try:
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+    finally:
+        for server in servers:
+            server.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nPort Forwarder shutdown successfully")
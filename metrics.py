@@ -0,0 +1,66 @@
+import http.server
+import threading
+
+# Serves the port forwarder's counters over HTTP in the Prometheus text format. Samples are given as
+# a list of (name, labels, value) where labels is a tuple of (label, value) pairs, and definitions is
+# a dictionary which maps every metric name to (type, help text).
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# This function formats the samples in the Prometheus text exposition format.
+def format_metrics(samples, definitions):
+    by_name = {}
+    for name, labels, value in samples:
+        by_name.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in by_name:
+        metric_type, help_text = definitions[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in by_name[name]:
+            if labels:
+                label_text = ','.join(f'{label}="{escape_label(label_value)}"' for label, label_value in labels)
+                lines.append(f"{name}{{{label_text}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+# This function adds up samples with the same name and labels, for example the samples reported by
+# several worker processes.
+def merge_samples(sample_lists):
+    totals = {}
+    for samples in sample_lists:
+        for name, labels, value in samples:
+            totals[(name, labels)] = totals.get((name, labels), 0) + value
+    return [(name, labels, value) for (name, labels), value in totals.items()]
+
+
+# This function starts an HTTP server in a daemon thread which answers GET /metrics with the samples
+# returned by collect(), and returns the server.
+def start_metrics_server(address, collect, definitions):
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = format_metrics(collect(), definitions).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Requests are not logged, the endpoint is polled frequently.
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -3,6 +3,55 @@ import select
 import threading
 import sys
 import ipaddress
+import errno
+import os
+import time
+import argparse
+import signal
+import multiprocessing
+import random
+import codecs
+import struct
+import collections
+import json
+import metrics
+from multiprocessing.connection import wait
+
+# Command Line Argument Parsing
+parser = argparse.ArgumentParser()
+parser.add_argument("-w", "--workers", dest="workers", default=0, required=False,
+                    help="Number of worker processes to run. Each worker has its own listening sockets bound with "
+                         "SO_REUSEPORT, and the kernel spreads new connections across them. Default value is 0 "
+                         "meaning run everything in a single process.")
+parser.add_argument("-t", "--relay-threads", dest="relay_threads", default=1, required=False,
+                    help="Number of relay threads per process. Each thread has its own epoll object and connection "
+                         "table, and new connections are given to the thread with the fewest connections. "
+                         "Default value is 1.")
+parser.add_argument("-q", "--quiet", dest="quiet", action="store_true", required=False,
+                    help="If this flag is present then no line is printed for every connection that is opened or "
+                         "closed.")
+parser.add_argument("-e", "--edge-triggered", dest="edge_triggered", action="store_true", required=False,
+                    help="If this flag is present then sockets are registered edge-triggered, and every readable "
+                         "socket is drained until it would block instead of being read once per event.")
+parser.add_argument("-m", "--metrics-port", dest="metrics_port", default=0, required=False,
+                    help="Port on 127.0.0.1 on which the counters are served at /metrics in the Prometheus text "
+                         "format. Default value is 0 meaning no metrics endpoint.")
+parser.add_argument("-d", "--drain-timeout", dest="drain_timeout", default=300, required=False,
+                    help="Number of seconds the port forwarder waits for open connections to finish after SIGTERM "
+                         "or an upgrade, before it closes them and exits. Default value is 300.")
+parser.add_argument("-u", "--upgrade-socket", dest="upgrade_socket", default='', required=False,
+                    help="Path of a Unix socket on which the port forwarder hands its listening sockets over to a "
+                         "new port forwarder started with -T, after which it stops accepting connections, lets its "
+                         "open connections finish and exits. Can't be used together with -w.")
+parser.add_argument("-T", "--takeover", dest="takeover", action="store_true", required=False,
+                    help="If this flag is present then the listening sockets are taken over from the port forwarder "
+                         "serving the -u upgrade socket instead of being bound, so that no connection is refused "
+                         "during an upgrade.")
+parser.add_argument("-C", "--takeover-connections", dest="takeover_connections", action="store_true",
+                    required=False,
+                    help="If this flag is present together with -T then the open connections which have no data "
+                         "waiting to be relayed are taken over as well, instead of being left to finish in the old "
+                         "port forwarder.")
 
 # Network Variables
 server_host_ipv4 = ''
@@ -14,21 +63,283 @@ internal_host_ipv6 = ''
 #   key = external facing port on port forwarder, value = port of internal machine to forward to.
 port_mapping = {}
 
+# Contains extra options for each port mapping, given as key=value pairs after the ports, where:
+#   key = external facing port on port forwarder, value = dictionary of options.
+mapping_options = {}
+
+# Relay engines which can be selected per port mapping with engine=<name>. The copy engine reads
+# the data into Python and sends it, the splice engine moves it between the sockets through a pipe
+# inside the kernel. The splice engine falls back to the copy engine when os.splice is unavailable.
+RELAY_ENGINES = ('copy', 'splice')
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
+# Number of bytes read from a socket by a single recv_into call, can be changed per port mapping
+# with read_size=<bytes>. Small sizes suit interactive mappings, large sizes suit bulk transfers.
+DEFAULT_READ_SIZE = 65536
+MAX_READ_SIZE = 16777216
+
+# Options which can be given after the ports of a port mapping.
+MAPPING_OPTIONS = ('engine', 'read_size', 'defer_accept', 'backends', 'balance', 'warm_pool', 'warm_pool_idle',
+                   'health_check', 'health_send', 'health_expect', 'idle_timeout', 'max_lifetime', 'connect_timeout',
+                   'max_connections', 'max_per_ip', 'accept_rate', 'ip_accept_rate', 'bandwidth',
+                   'connection_bandwidth', 'priority', 'quantum')
+
+# Timeouts which can be set per port mapping in seconds, 0 means no timeout:
+#   idle_timeout: close a connection pair when neither side has sent anything for this long.
+#   max_lifetime: close a connection pair this long after it was established.
+#   connect_timeout: give up on connecting to the internal host after this long, defaults to CONNECT_TIMEOUT.
+TIMEOUT_OPTIONS = ('idle_timeout', 'max_lifetime', 'connect_timeout')
+
+# Limits on the connections admitted to a port mapping, 0 means no limit:
+#   max_connections: number of open connections on the mapping.
+#   max_per_ip: number of open connections on the mapping from one source IP address.
+#   accept_rate: new connections per second on the mapping, with bursts of up to one second's worth.
+#   ip_accept_rate: new connections per second on the mapping from one source IP address.
+# Connections over a limit are reset right after they have been accepted.
+ADMISSION_OPTIONS = ('max_connections', 'max_per_ip', 'accept_rate', 'ip_accept_rate')
+
+# Bandwidth limits of a port mapping in bytes per second, 0 means no limit:
+#   bandwidth: data relayed by all connections of the mapping together, in both directions.
+#   connection_bandwidth: data relayed by one connection pair, in both directions.
+# A socket which has used up its share is not read from until the limit allows it again, so the data
+# waits in the kernel and the sender is slowed down by TCP flow control.
+BANDWIDTH_OPTIONS = ('bandwidth', 'connection_bandwidth')
+
+# Scheduling of the readable sockets in each iteration of the relay loop:
+#   priority: sockets of mappings with a higher priority are read first, defaults to 0.
+#   quantum: bytes a socket may relay per iteration, defaults to FAIRNESS_BUDGET. A read never asks for
+#            more than what is left of the quantum, so every socket gets the same share of each iteration.
+# Giving bulk mappings a small quantum and interactive mappings a higher priority keeps the iterations
+# short, so the interactive sockets are read soon after their data arrives even while the bulk ones are busy.
+
+# Token buckets of the bandwidth option where:
+#   key = external facing port on port forwarder, value = [bytes, time of last update].
+# The buckets are shared by the relay threads, so they are only changed while holding bandwidth_lock.
+mapping_buckets = {}
+bandwidth_lock = threading.Lock()
+
+# Holds the mapping and source IP address of every admitted external connection where:
+#   key = external socket file descriptor, value = (external facing port, source IP address).
+client_addresses = {}
+
+# Holds the number of open connections on each port mapping where:
+#   key = external facing port on port forwarder, value = number of connections.
+mapping_connections = {}
+
+# Holds the number of open connections from each source IP address where:
+#   key = (external facing port, source IP address), value = number of connections.
+# Addresses without open connections are removed, so this only holds the clients which are connected.
+client_connections = {}
+
+# Protects the connection counts, which are increased by the main thread and decreased by the relay threads.
+admission_lock = threading.Lock()
+
+# Token buckets of accept_rate and ip_accept_rate where:
+#   key = external facing port, or (external facing port, source IP address), value = [tokens, time of last update].
+accept_buckets = {}
+client_buckets = {}
+
+# Once client_buckets holds more than CLIENT_BUCKET_LIMIT buckets, the ones which have filled up again are
+# removed, as a full bucket behaves the same as a missing one.
+CLIENT_BUCKET_LIMIT = 65536
+
+# Number of connections rejected where:
+#   key = (external facing port, reason), value = number of connections.
+rejected_connections = {}
+
+# A port mapping with warm_pool=<n> keeps n idle connections open to each of its backends, so that a
+# new client can be forwarded without waiting for a handshake with the internal host. Idle connections
+# are closed after warm_pool_idle=<seconds>, which defaults to WARM_POOL_IDLE.
+WARM_POOL_IDLE = 30
+
+# Number of seconds between two refills of the warm pools.
+WARM_POOL_INTERVAL = 1
+
+# Contains the internal hosts each port mapping forwards to where:
+#   key = external facing port on port forwarder, value = list of backend dictionaries.
+# By default a mapping forwards to the port of the internal host with the same IP version as the
+# client. With backends=host:port[@weight],... the mapping forwards to any of the listed hosts,
+# IPv6 hosts are written in brackets like [::1]:8000.
+mapping_backends = {}
+
+# Ways of choosing a backend which can be selected per port mapping with balance=<name>.
+#   least_conn: the backend with the fewest active connections relative to its weight.
+#   round_robin: each backend in turn.
+#   weighted: each backend in turn, as many times as its weight.
+BALANCE_METHODS = ('least_conn', 'round_robin', 'weighted')
+
+# Next backend to use for each port mapping balanced with round_robin.
+round_robin_index = {}
+
+# Protects the active connection counts and health states of the backends, which are changed by the
+# main thread, the relay threads and the health check thread.
+backend_lock = threading.Lock()
+
+# Every backend is in one of these health states:
+#   up: new connections are forwarded to it.
+#   down: FAILURE_THRESHOLD connections or health checks in a row have failed, nothing is forwarded to
+#         it until a health check succeeds or CIRCUIT_OPEN_TIME seconds have passed.
+#   recovering: it is given a growing share of its new connections over RECOVERY_TIME seconds, and is
+#               marked down again as soon as anything fails.
+FAILURE_THRESHOLD = 3
+CIRCUIT_OPEN_TIME = 10
+RECOVERY_TIME = 30
+
+# A port mapping with health_check=<seconds> connects to each of its backends at that interval. With
+# health_send=<text> the text is sent once connected, and with health_expect=<text> the response
+# must contain the text. Escapes like \r\n can be used in both.
+HEALTH_CHECK_TIMEOUT = 2
+
 # This holds all the listening sockets where key = file descriptor, and val = socket obj
 listening_socket_list = {}
 
-# Holds all connections
-communication_map = {}
+# This holds the port of every listening socket where key = file descriptor, and val = external facing port.
+listening_ports = {}
+
+# Maximum number of connections accepted from one listening socket per event in level-triggered mode,
+# so that a connection storm on one port does not hold up the other listening sockets.
+ACCEPT_BATCH = 64
+
+# Listening sockets which are not polled for a while because a connection could not be set up for lack of
+# resources, such as file descriptors, where:
+#   key = listening socket file descriptor, value = time at which the socket is polled again.
+# Registering the socket again makes epoll check it, so no connection is missed in edge-triggered mode.
+paused_listeners = {}
+ACCEPT_RETRY_DELAY = 0.1
+
+# Port of the metrics endpoint set with the -m command line flag, 0 means no metrics endpoint.
+metrics_port = 0
+metrics_server = None
+
+# Set with the -q command line flag to stop printing a line for every connection.
+quiet = False
+
+# Holds connections to the internal host which are still being established where:
+#   key = internal socket file descriptor, value = (external socket, internal socket, deadline, external port, backend).
+# Connections made for a warm pool have no external socket yet, so the external socket is None. The deadline
+# is None if the port mapping has no connect timeout.
+pending_connections = {}
+
+# Number of seconds to wait for the internal host to accept a connection before giving up, unless the
+# port mapping sets connect_timeout.
+CONNECT_TIMEOUT = 5
+
+# Resolution in seconds and number of slots of the timer wheels. Timers further away than one turn of the
+# wheel stay in their slot until the wheel has come round to them.
+TIMER_TICK = 0.1
+TIMER_SLOTS = 4096
+
+# Number of connections to the internal host which timed out for each port mapping where:
+#   key = external facing port on port forwarder, value = number of connections.
+connect_timeouts = {}
+
+# Connect timeouts of the pending connections, keyed by the internal socket file descriptor.
+connect_timers = None
+
+# Once an output buffer grows past HIGH_WATERMARK bytes, reading from the peer is paused
+# until the buffer drains below LOW_WATERMARK bytes.
+HIGH_WATERMARK = 262144
+LOW_WATERMARK = 65536
+
+# Maximum number of free buffers kept for each buffer size.
+BUFFER_POOL_LIMIT = 64
+
+# Maximum number of bytes moved by a single splice call, this matches the default pipe capacity.
+SPLICE_SIZE = 65536
 
 # Epoll object to handle client connections.
 multiplexor = select.epoll()
 
-# Epoll object to handle file descriptors currently involved in an established connection.
-io = select.epoll()
+# Set with the -e command line flag. Sockets are then registered edge-triggered, the relay reads each
+# readable socket until it would block or until the quantum of its mapping has been relayed, and the
+# listening sockets accept connections until their backlog is empty.
+edge_triggered = False
+
+# Default quantum, the number of bytes relayed from one socket before the relay moves on to other sockets.
+# A socket which still has data left is read again on the next loop iteration.
+FAIRNESS_BUDGET = 1048576
+
+# Relay shards, each runs its own thread with its own epoll object and connection table.
+relay_shards = []
+
+# Number of relay shards to start, can be changed with the -t command line flag.
+relay_threads = 1
 
 # boolean for if the server is running or not. Used to signal shutdown of child thread.
 running = True
 
+# Control channel of the main loop, created when the port forwarder starts. Signal handlers queue
+# ('reload',) for SIGHUP and ('drain',) for SIGTERM on it, and relay shards queue ('idle',) when their
+# last connection has closed while draining.
+main_control = None
+
+# Set to wake up the health check thread, when shutting down or after a reload.
+health_wakeup = threading.Event()
+
+# Path of the upgrade socket set with the -u command line flag, and the listening Unix socket bound to it.
+upgrade_socket = ''
+upgrade_listener = None
+
+# Set with the -T and -C command line flags.
+takeover = False
+takeover_connections = False
+
+# Number of seconds the old and the new process wait for each other during an upgrade.
+UPGRADE_TIMEOUT = 10
+
+# Maximum number of file descriptors sent in one message during an upgrade, the kernel allows 253.
+UPGRADE_BATCH = 250
+
+# Maximum size of one message sent during an upgrade.
+UPGRADE_MESSAGE_SIZE = 65536
+
+# Set on SIGTERM or once the listening sockets have been handed to a new process. The listeners are then
+# closed, and the main loop exits as soon as every connection has finished, or once drain_timeout seconds
+# have passed. drain_timeout can be changed with the -d command line flag.
+draining = False
+drain_deadline = 0
+drain_timeout = 300
+
+# Set when running as a worker process, the listening sockets are then bound with SO_REUSEPORT so that
+# every worker can listen on the same ports.
+reuse_port = False
+
+# Pipe used by a worker process to report its statistics to the supervisor, None in single process mode.
+stats_pipe = None
+
+# Number of seconds between two statistics reports from a worker process.
+STATS_INTERVAL = 5
+
+# Number of seconds to wait before restarting a crashed worker, and to wait for the workers to
+# shut down before they are interrupted by the supervisor.
+WORKER_RESTART_DELAY = 1
+WORKER_SHUTDOWN_TIMEOUT = 5
+
+# Total number of connection pairs established since start up.
+total_connections = 0
+
+# Number of connections accepted on each port mapping where:
+#   key = external facing port on port forwarder, value = number of accepted connections.
+accepted_connections = {}
+
+# Metrics served on the metrics endpoint where:
+#   key = metric name, value = (metric type, help text).
+METRICS = {
+    'port_forwarder_accepted_connections_total': ('counter', 'Connections accepted from external hosts.'),
+    'port_forwarder_connections_total': ('counter', 'Connection pairs established to the internal host.'),
+    'port_forwarder_active_connections': ('gauge', 'Connections currently forwarded, including pending ones.'),
+    'port_forwarder_connect_failures_total': ('counter', 'Failed connections to the internal host.'),
+    'port_forwarder_backend_up': ('gauge', '1 if the internal host is up, 0.5 if recovering and 0 if down.'),
+    'port_forwarder_bytes_total': ('counter', 'Bytes relayed, in is from the external host to the internal host.'),
+    'port_forwarder_relay_errors_total': ('counter', 'Connections closed because of a socket error while relaying.'),
+    'port_forwarder_buffer_pool_hits_total': ('counter', 'Reads which reused a buffer from the buffer pool.'),
+    'port_forwarder_buffer_pool_misses_total': ('counter', 'Reads which had to allocate a new buffer.'),
+    'port_forwarder_poll_calls_total': ('counter', 'Calls to poll made by the relay threads.'),
+    'port_forwarder_timeouts_total': ('counter', 'Connections closed by the idle, lifetime or connect timeout.'),
+    'port_forwarder_rejected_connections_total': ('counter', 'Connections reset by a connection or rate limit.'),
+    'port_forwarder_throttled_reads_total': ('counter', 'Reads deferred by a bandwidth limit.'),
+}
+
 
 # This function checks if the given address is a valid IPv4/IPv6 address, returns True if it
 # is valid, and returns False if it is invalid.
@@ -42,68 +353,495 @@ def valid_ip(address):
 
 # This function checks to make sure that the ports from the configuration file,
 # are in the typical port range.
-def validate_port_mappings():
-    for key in port_mapping:
+def validate_port_mappings(config):
+    for key in config['port_mapping']:
         if key > 65535 or key < 1:
             return False
-        if port_mapping[key] > 65535 or port_mapping[key] < 1:
+        if config['port_mapping'][key] > 65535 or config['port_mapping'][key] < 1:
             return False
     return True
 
 
-# Read config file and validate
-try:
-    with open('./config', 'r') as config:
-        # Validate the configuration file to ensure it is using proper syntax and types.
-        lines = config.readlines()
-        if len(lines) <= 4:
-            print("Incomplete Configuration File, there should be at least 5 lines.", file=sys.stderr)
-            sys.exit(0)
-        server_host_ipv4 = lines[0].split()[1]
-        internal_host_ipv4 = lines[1].split()[1]
-        server_host_ipv6 = lines[2].split()[1]
-        internal_host_ipv6 = lines[3].split()[1]
-        # Check whether IP addresses are valid IP addresses.
-        if not (valid_ip(server_host_ipv4) and valid_ip(internal_host_ipv4)):
-            print("Invalid IPv4 strings detected in config file.", file=sys.stderr)
-            sys.exit(0)
-        if not (valid_ip(server_host_ipv6) and valid_ip(internal_host_ipv6)):
-            print("Invalid IPv6 strings detected in config file.", file=sys.stderr)
-            sys.exit(0)
-        # If the IPs are valid - check the port mappings.
-        counter = 4
-        while counter < len(lines):
-            temp = lines[counter].split()
+# This function checks the options given for each port mapping, and creates the backends of each
+# mapping. It prints the problem and returns False if an option is unknown or has an invalid value.
+def validate_mapping_options(config):
+    for key in config['mapping_options']:
+        options = config['mapping_options'][key]
+        for name in options:
+            if name not in MAPPING_OPTIONS:
+                print(f"Unknown option '{name}' for port mapping {key}.", file=sys.stderr)
+                return False
+        options.setdefault('engine', 'copy')
+        if options['engine'] not in RELAY_ENGINES:
+            print(f"Invalid engine '{options['engine']}' for port mapping {key}. "
+                  f"Use one of {', '.join(RELAY_ENGINES)}.", file=sys.stderr)
+            return False
+        if options['engine'] == 'splice' and not SPLICE_AVAILABLE:
+            print(f"os.splice is not available, port mapping {key} will use the copy engine.", file=sys.stderr)
+            options['engine'] = 'copy'
+        try:
+            options['read_size'] = int(options.get('read_size', DEFAULT_READ_SIZE))
+        except ValueError:
+            print(f"Invalid read_size for port mapping {key}. Integers only.", file=sys.stderr)
+            return False
+        if options['read_size'] < 1 or options['read_size'] > MAX_READ_SIZE:
+            print(f"Invalid read_size for port mapping {key}. It must be in the range 1 - {MAX_READ_SIZE}.",
+                  file=sys.stderr)
+            return False
+        # Number of seconds the kernel waits for the client to send data before the connection is
+        # accepted, 0 means accept as soon as the handshake is done.
+        try:
+            options['defer_accept'] = int(options.get('defer_accept', 0))
+        except ValueError:
+            print(f"Invalid defer_accept for port mapping {key}. Integers only.", file=sys.stderr)
+            return False
+        if options['defer_accept'] < 0:
+            print(f"Invalid defer_accept for port mapping {key}. It can't be negative.", file=sys.stderr)
+            return False
+        for name in ('warm_pool', 'warm_pool_idle'):
+            try:
+                options[name] = int(options.get(name, WARM_POOL_IDLE if name == 'warm_pool_idle' else 0))
+            except ValueError:
+                print(f"Invalid {name} for port mapping {key}. Integers only.", file=sys.stderr)
+                return False
+            if options[name] < 0:
+                print(f"Invalid {name} for port mapping {key}. It can't be negative.", file=sys.stderr)
+                return False
+        try:
+            options['quantum'] = int(options.get('quantum', FAIRNESS_BUDGET))
+        except ValueError:
+            print(f"Invalid quantum for port mapping {key}. Integers only.", file=sys.stderr)
+            return False
+        if options['quantum'] < 1:
+            print(f"Invalid quantum for port mapping {key}. It must be at least 1.", file=sys.stderr)
+            return False
+        try:
+            options['health_check'] = int(options.get('health_check', 0))
+        except ValueError:
+            print(f"Invalid health_check for port mapping {key}. Integers only.", file=sys.stderr)
+            return False
+        if options['health_check'] < 0:
+            print(f"Invalid health_check for port mapping {key}. It can't be negative.", file=sys.stderr)
+            return False
+        for name in TIMEOUT_OPTIONS + ADMISSION_OPTIONS + BANDWIDTH_OPTIONS + ('priority',):
             try:
-                port_mapping[int(temp[0])] = int(temp[1])
+                options[name] = int(options.get(name, CONNECT_TIMEOUT if name == 'connect_timeout' else 0))
             except ValueError:
-                print("Invalid data type for port mappings. Integers only.", file=sys.stderr)
-                sys.exit(0)
-            counter = counter + 1
-        if not validate_port_mappings():
-            print("Invalid ports supplied. Ports must be in the range 1 - 65535.", file=sys.stderr)
-            sys.exit(0)
-        print(f"Port Forwarder IPv4: {server_host_ipv4}")
-        print(f"Port Forwarder IPv6: {server_host_ipv6}")
-        print(f"Internal IPv4: {internal_host_ipv4}")
-        print(f"Internal IPv6: {internal_host_ipv6}")
-        print(f"Port Mapping: {port_mapping}")
-except FileNotFoundError:
-    print("No config file found. Make sure a file named 'config' is in the same directory as 'port_forwarder.py'.",
-          file=sys.stderr)
+                print(f"Invalid {name} for port mapping {key}. Integers only.", file=sys.stderr)
+                return False
+            if options[name] < 0:
+                print(f"Invalid {name} for port mapping {key}. It can't be negative.", file=sys.stderr)
+                return False
+        for name in ('health_send', 'health_expect'):
+            try:
+                options[name] = codecs.decode(options.get(name, ''), 'unicode_escape').encode('latin-1')
+            except UnicodeError:
+                print(f"Invalid {name} for port mapping {key}. Use characters up to \\xff and valid escapes only.",
+                      file=sys.stderr)
+                return False
+        options.setdefault('balance', 'least_conn')
+        if options['balance'] not in BALANCE_METHODS:
+            print(f"Invalid balance '{options['balance']}' for port mapping {key}. "
+                  f"Use one of {', '.join(BALANCE_METHODS)}.", file=sys.stderr)
+            return False
+        if 'backends' in options:
+            backends = parse_backends(options['backends'])
+            if backends is None:
+                print(f"Invalid backends for port mapping {key}. Expected host:port[@weight],... with ports in the "
+                      f"range 1 - 65535 and weights of at least 1.", file=sys.stderr)
+                return False
+        else:
+            backends = [new_backend(config['internal_host_ipv4'], config['port_mapping'][key], 1, match_family=True),
+                        new_backend(config['internal_host_ipv6'], config['port_mapping'][key], 1, match_family=True)]
+        config['mapping_backends'][key] = backends
+    return True
+
+
+def new_backend(host, port, weight, match_family=False):
+    return {
+        'address': (host, port),
+        # Address of the backend as it is shown in the metrics.
+        'name': f"[{host}]:{port}" if ':' in host else f"{host}:{port}",
+        'family': socket.AF_INET6 if ':' in host else socket.AF_INET,
+        # Default backends are only used for clients of the same IP version.
+        'match_family': match_family,
+        'weight': weight,
+        # Number of connections currently forwarded to this backend, including pending ones.
+        'active': 0,
+        # Used by the weighted balance method.
+        'current_weight': 0,
+        # Idle connections of the warm pool as a list of (socket, time connected).
+        'idle': [],
+        # Number of warm pool connections which are still being established.
+        'warming': 0,
+        # Health state of the backend, see FAILURE_THRESHOLD.
+        'state': 'up',
+        'state_changed': time.monotonic(),
+        'failures': 0,
+        # Time of the next health check.
+        'next_check': 0,
+        # Number of connections established to the backend, and number of connections to it which failed.
+        'connections': 0,
+        'connect_failures': 0,
+        # Set once the backend has been removed from the config by a reload.
+        'removed': False,
+    }
+
+
+# This function parses a list of backends in the form host:port[@weight],... and returns a list of
+# backend dictionaries, or None if the list is invalid.
+def parse_backends(text):
+    backends = []
+    for entry in text.split(','):
+        address, separator, weight = entry.partition('@')
+        host, separator, port = address.rpartition(':')
+        host = host.strip('[]')
+        if not valid_ip(host):
+            return None
+        try:
+            port = int(port)
+            weight = int(weight) if weight else 1
+        except ValueError:
+            return None
+        if port > 65535 or port < 1 or weight < 1:
+            return None
+        backends.append(new_backend(host, port, weight))
+    return backends
+
+
+# This function chooses the backend for a new connection on the given port mapping using the mapping's
+# balance method, and counts the connection as active on that backend. Backends which are down are
+# skipped. Returns None if the mapping has no available backend for the client's IP version.
+def choose_backend(port, family):
+    now = time.monotonic()
+    balance = mapping_options[port]['balance']
+    with backend_lock:
+        candidates = [backend for backend in mapping_backends[port]
+                      if (not backend['match_family'] or backend['family'] == family)
+                      and backend_available(backend, now)]
+        if not candidates:
+            return None
+        if balance == 'least_conn':
+            backend = min(candidates, key=lambda candidate: candidate['active'] / candidate['weight'])
+        elif balance == 'round_robin':
+            backend = candidates[round_robin_index[port] % len(candidates)]
+            round_robin_index[port] += 1
+        else:
+            # Smooth weighted round robin, heavier backends are chosen more often but not in a row.
+            total = 0
+            for candidate in candidates:
+                candidate['current_weight'] += candidate['weight']
+                total += candidate['weight']
+            backend = max(candidates, key=lambda candidate: candidate['current_weight'])
+            backend['current_weight'] -= total
+        backend['active'] += 1
+    return backend
+
+
+# This function is called when a connection forwarded to the backend has closed or failed.
+def release_backend(backend):
+    with backend_lock:
+        backend['active'] -= 1
+
+
+def set_backend_state(backend, state, now):
+    backend['state'] = state
+    backend['state_changed'] = now
+    print(f"Internal host {backend['address']} is {state}", file=sys.stderr)
+
+
+# This function decides whether a new connection may be forwarded to the backend. It must be called
+# with backend_lock held.
+def backend_available(backend, now):
+    if backend['state'] == 'down':
+        if now - backend['state_changed'] < CIRCUIT_OPEN_TIME:
+            return False
+        # Let a few connections through to find out whether the backend is back.
+        set_backend_state(backend, 'recovering', now)
+    if backend['state'] == 'recovering':
+        share = (now - backend['state_changed']) / RECOVERY_TIME
+        if share >= 1:
+            set_backend_state(backend, 'up', now)
+            return True
+        return random.random() < max(share, 0.1)
+    return True
+
+
+# This function is called when a connection to the backend or a health check of it has failed.
+def record_failure(backend):
+    with backend_lock:
+        backend['failures'] += 1
+        if backend['state'] == 'recovering' or (backend['state'] == 'up' and backend['failures'] >= FAILURE_THRESHOLD):
+            set_backend_state(backend, 'down', time.monotonic())
+
+
+# This function is called when a connection to the backend or a health check of it has succeeded.
+def record_success(backend, health_check=False):
+    with backend_lock:
+        backend['failures'] = 0
+        # Only a health check brings a backend back before CIRCUIT_OPEN_TIME has passed.
+        if health_check and backend['state'] == 'down':
+            set_backend_state(backend, 'recovering', time.monotonic())
+
+
+# This function takes a token from the bucket with the given key, which is refilled at rate tokens per
+# second up to rate tokens. Returns False if the bucket is empty.
+def take_token(buckets, key, rate, now):
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = [rate, now]
+    bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] < 1:
+        return False
+    bucket[0] -= 1
+    return True
+
+
+# This function takes the given number of bytes from a bandwidth bucket, which is refilled at rate bytes per
+# second up to rate bytes. The bucket may go below zero, the read which emptied it is paid back before the
+# next one. Returns the number of seconds until the bucket holds a byte again, or 0 if it still does.
+def charge_bucket(bucket, rate, size, now):
+    bucket[0] = min(rate, bucket[0] + max(0, now - bucket[1]) * rate) - size
+    bucket[1] = max(bucket[1], now)
+    if bucket[0] > 0:
+        return 0
+    return (1 - bucket[0]) / rate
+
+
+# This function removes the source address buckets which have filled up again.
+def prune_client_buckets(now):
+    for key in list(client_buckets):
+        rate = mapping_options[key[0]]['ip_accept_rate']
+        tokens, updated = client_buckets[key]
+        if tokens + (now - updated) * rate >= rate:
+            del client_buckets[key]
+
+
+# This function checks a newly accepted connection against the limits of its port mapping, and counts it
+# if it is admitted. Returns None if the connection is admitted, or the name of the limit it is over.
+def admit_connection(fd, port, address):
+    options = mapping_options[port]
+    now = time.monotonic()
+    if options['accept_rate'] and not take_token(accept_buckets, port, options['accept_rate'], now):
+        return 'accept_rate'
+    if options['ip_accept_rate']:
+        if len(client_buckets) > CLIENT_BUCKET_LIMIT:
+            prune_client_buckets(now)
+        if not take_token(client_buckets, (port, address), options['ip_accept_rate'], now):
+            return 'ip_accept_rate'
+    client = (port, address)
+    with admission_lock:
+        if options['max_connections'] and mapping_connections.get(port, 0) >= options['max_connections']:
+            return 'max_connections'
+        if options['max_per_ip'] and client_connections.get(client, 0) >= options['max_per_ip']:
+            return 'max_per_ip'
+        mapping_connections[port] = mapping_connections.get(port, 0) + 1
+        client_connections[client] = client_connections.get(client, 0) + 1
+    client_addresses[fd] = client
+    return None
+
+
+# This function is called before a socket is closed, and uncounts it if it is an admitted external connection.
+def release_client(fd):
+    client = client_addresses.pop(fd, None)
+    if client is None:
+        return
+    with admission_lock:
+        mapping_connections[client[0]] -= 1
+        client_connections[client] -= 1
+        if client_connections[client] == 0:
+            del client_connections[client]
+
+
+# This function resets a connection which is over a limit, without leaving the socket in TIME_WAIT.
+def reject_connection(sock, port, reason):
+    rejected_connections[(port, reason)] = rejected_connections.get((port, reason), 0) + 1
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    sock.close()
+
+
+# This function connects to the backend, sends the health_send text and checks that the response
+# contains the health_expect text. Returns True if the backend is healthy.
+def probe_backend(backend, send, expect):
+    try:
+        with socket.create_connection(backend['address'], timeout=HEALTH_CHECK_TIMEOUT) as sock:
+            if send:
+                sock.sendall(send)
+            if not expect:
+                return True
+            response = b""
+            while expect not in response:
+                data = sock.recv(4096)
+                if not data:
+                    return False
+                response += data
+            return True
+    except OSError:
+        return False
+
+
+# This thread runs the health checks of every port mapping with health_check set. It sleeps until the
+# next check is due, or until it is woken up by health_wakeup.
+def health_check_thread():
+    while running:
+        health_wakeup.clear()
+        next_check = None
+        # The mappings are copied first, a reload may change them while the checks run.
+        for key, backends in list(mapping_backends.items()):
+            interval = mapping_options[key]['health_check']
+            if interval == 0:
+                continue
+            for backend in backends:
+                if not running:
+                    return
+                if time.monotonic() >= backend['next_check']:
+                    if probe_backend(backend, mapping_options[key]['health_send'],
+                                     mapping_options[key]['health_expect']):
+                        record_success(backend, health_check=True)
+                    else:
+                        record_failure(backend)
+                    backend['next_check'] = time.monotonic() + interval
+                if next_check is None or backend['next_check'] < next_check:
+                    next_check = backend['next_check']
+        health_wakeup.wait(None if next_check is None else max(0, next_check - time.monotonic()))
+
+
+# This function reads and validates the config file. It returns a dictionary holding the addresses,
+# port mapping, mapping options and backends, or prints the problem and returns None if the config
+# file is missing or invalid. Nothing is changed in the running config.
+def read_config():
+    config = {'port_mapping': {}, 'mapping_options': {}, 'mapping_backends': {}}
+    try:
+        with open('./config', 'r') as config_file:
+            lines = config_file.readlines()
+    except FileNotFoundError:
+        print("No config file found. Make sure a file named 'config' is in the same directory as "
+              "'port_forwarder.py'.", file=sys.stderr)
+        return None
+    # Validate the configuration file to ensure it is using proper syntax and types.
+    if len(lines) <= 4:
+        print("Incomplete Configuration File, there should be at least 5 lines.", file=sys.stderr)
+        return None
+    try:
+        config['server_host_ipv4'] = lines[0].split()[1]
+        config['internal_host_ipv4'] = lines[1].split()[1]
+        config['server_host_ipv6'] = lines[2].split()[1]
+        config['internal_host_ipv6'] = lines[3].split()[1]
+    except IndexError:
+        print("Missing IP address in config file.", file=sys.stderr)
+        return None
+    # Check whether IP addresses are valid IP addresses.
+    if not (valid_ip(config['server_host_ipv4']) and valid_ip(config['internal_host_ipv4'])):
+        print("Invalid IPv4 strings detected in config file.", file=sys.stderr)
+        return None
+    if not (valid_ip(config['server_host_ipv6']) and valid_ip(config['internal_host_ipv6'])):
+        print("Invalid IPv6 strings detected in config file.", file=sys.stderr)
+        return None
+    # If the IPs are valid - check the port mappings.
+    counter = 4
+    while counter < len(lines):
+        temp = lines[counter].split()
+        try:
+            config['port_mapping'][int(temp[0])] = int(temp[1])
+        except ValueError:
+            print("Invalid data type for port mappings. Integers only.", file=sys.stderr)
+            return None
+        except IndexError:
+            print(f"Incomplete port mapping on line {counter + 1} of config file.", file=sys.stderr)
+            return None
+        # Anything after the two ports is an option for this mapping in the form key=value.
+        options = {}
+        for option in temp[2:]:
+            name, separator, value = option.partition('=')
+            if not separator:
+                print(f"Invalid port mapping option '{option}', options must be in the form key=value.",
+                      file=sys.stderr)
+                return None
+            options[name] = value
+        config['mapping_options'][int(temp[0])] = options
+        counter = counter + 1
+    if not validate_port_mappings(config):
+        print("Invalid ports supplied. Ports must be in the range 1 - 65535.", file=sys.stderr)
+        return None
+    if not validate_mapping_options(config):
+        return None
+    return config
+
+
+# This function makes the given config the running config. Backends which are in both the old and the
+# new config keep their dictionary, so that their connection counts, health state and warm pool carry
+# over. Returns the backends which are no longer in the config.
+def apply_config(config):
+    global server_host_ipv4, internal_host_ipv4, server_host_ipv6, internal_host_ipv6
+    server_host_ipv4 = config['server_host_ipv4']
+    internal_host_ipv4 = config['internal_host_ipv4']
+    server_host_ipv6 = config['server_host_ipv6']
+    internal_host_ipv6 = config['internal_host_ipv6']
+    removed_backends = []
+    for key in list(mapping_backends):
+        if key not in config['port_mapping']:
+            removed_backends.extend(mapping_backends.pop(key))
+    for key in config['mapping_backends']:
+        old_backends = {(backend['address'], backend['match_family']): backend
+                        for backend in mapping_backends.get(key, [])}
+        backends = []
+        for backend in config['mapping_backends'][key]:
+            old_backend = old_backends.pop((backend['address'], backend['match_family']), None)
+            if old_backend is not None:
+                old_backend['weight'] = backend['weight']
+                backend = old_backend
+            backends.append(backend)
+        removed_backends.extend(old_backends.values())
+        mapping_backends[key] = backends
+        round_robin_index.setdefault(key, 0)
+    for backend in removed_backends:
+        backend['removed'] = True
+    port_mapping.clear()
+    port_mapping.update(config['port_mapping'])
+    # The options of removed mappings are kept, connections which are still open on a removed mapping
+    # keep using them.
+    mapping_options.update(config['mapping_options'])
+    return removed_backends
+
+
+def print_config():
+    print(f"Port Forwarder IPv4: {server_host_ipv4}")
+    print(f"Port Forwarder IPv6: {server_host_ipv6}")
+    print(f"Internal IPv4: {internal_host_ipv4}")
+    print(f"Internal IPv6: {internal_host_ipv6}")
+    print(f"Port Mapping: {port_mapping}")
+    print(f"Mapping Options: {mapping_options}")
+    for key in mapping_backends:
+        print(f"Backends for port {key}: {[backend['address'] for backend in mapping_backends[key]]}")
+
+
+# Read config file and validate
+startup_config = read_config()
+if startup_config is None:
     sys.exit(0)
+apply_config(startup_config)
+print_config()
 
 
-# This function creates and sets up all the listening server sockets.
-def port_forward_setup():
-    # For each mapping: create a socket, set the socket options, bind, and register.
-    for key in port_mapping:
-        # Create ipv4 and ipv6 listening sockets
-        listen_ipv4_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listen_ipv6_sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+# This function creates and sets up the listening server sockets of one port mapping.
+def open_listeners(key):
+    # Create ipv4 and ipv6 listening sockets
+    listen_ipv4_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_ipv6_sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    try:
         # Set socket options
         listen_ipv4_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         listen_ipv6_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            listen_ipv4_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            listen_ipv6_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Only wake up for connections on which the client has already sent data, this must not be used
+        # for protocols where the server speaks first, such as SSH.
+        defer_accept = mapping_options[key]['defer_accept']
+        if defer_accept:
+            listen_ipv4_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, defer_accept)
+            listen_ipv6_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, defer_accept)
         listen_ipv4_sock.setblocking(0)
         listen_ipv6_sock.setblocking(0)
         # Bind sockets to each port, the first index of each mapping is the port
@@ -113,99 +851,1529 @@ def port_forward_setup():
         # Start listening on the socket.
         listen_ipv4_sock.listen(10000)
         listen_ipv6_sock.listen(10000)
-        # Add sockets to socket dictionary
-        listening_socket_list[listen_ipv4_sock.fileno()] = listen_ipv4_sock
-        listening_socket_list[listen_ipv6_sock.fileno()] = listen_ipv6_sock
-        # Register file descriptors into listening socket list.
-        multiplexor.register(listen_ipv4_sock.fileno())
-        multiplexor.register(listen_ipv6_sock.fileno())
+    except OSError:
+        listen_ipv4_sock.close()
+        listen_ipv6_sock.close()
+        raise
+    register_listener(listen_ipv4_sock, key)
+    register_listener(listen_ipv6_sock, key)
+
+
+# This function adds a listening socket to the socket dictionaries and registers it with the multiplexor.
+def register_listener(sock, key):
+    listening_socket_list[sock.fileno()] = sock
+    listening_ports[sock.fileno()] = key
+    multiplexor.register(sock.fileno(), listener_events())
+
+
+def listener_events():
+    if edge_triggered:
+        return select.EPOLLIN | select.EPOLLET
+    return select.EPOLLIN
+
+
+# This function stops polling a listening socket for ACCEPT_RETRY_DELAY seconds, so the main loop does not
+# spin while connections can't be set up.
+def pause_listener(fd):
+    if fd in listening_socket_list and fd not in paused_listeners:
+        multiplexor.modify(fd, 0)
+        paused_listeners[fd] = time.monotonic() + ACCEPT_RETRY_DELAY
+
+
+# This function polls the paused listening sockets again once their delay has passed.
+def resume_listeners():
+    now = time.monotonic()
+    for fd in list(paused_listeners):
+        if paused_listeners[fd] <= now:
+            del paused_listeners[fd]
+            multiplexor.modify(fd, listener_events())
+
+
+def close_listener(fd):
+    paused_listeners.pop(fd, None)
+    multiplexor.unregister(fd)
+    listening_socket_list.pop(fd).close()
+    del listening_ports[fd]
+
+
+# This function creates and sets up all the listening server sockets.
+def port_forward_setup():
+    # For each mapping: create a socket, set the socket options, bind, and register.
+    for key in port_mapping:
+        open_listeners(key)
+
+
+# This function re-reads the config file and applies it without touching established connections.
+# Only the listeners of added and removed port mappings are opened and closed, and changed backends
+# and options only apply to new connections. If the config file is invalid the running config is kept.
+def reload_config():
+    config = read_config()
+    if config is None:
+        print("Config reload failed, keeping the running config.", file=sys.stderr)
+        return
+    rebind = (config['server_host_ipv4'], config['server_host_ipv6']) != (server_host_ipv4, server_host_ipv6)
+    defer_accept = {key: mapping_options[key]['defer_accept'] for key in port_mapping}
+    removed_backends = apply_config(config)
+    # Established pairs keep their removed backend until they close, only the warm pool is closed.
+    for backend in removed_backends:
+        for sock, connected in backend['idle']:
+            sock.close()
+        backend['idle'] = []
+    for fd in listening_ports:
+        key = listening_ports[fd]
+        if key in defer_accept and mapping_options[key]['defer_accept'] != defer_accept[key]:
+            listening_socket_list[fd].setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT,
+                                                 mapping_options[key]['defer_accept'])
+    opened, closed = update_listeners(rebind)
+    # The health check intervals may have changed.
+    health_wakeup.set()
+    print(f"Config reloaded, opened ports {sorted(opened)}, closed ports {sorted(closed)}, "
+          f"removed {len(removed_backends)} internal hosts")
+
+
+# This function closes the listeners of port mappings which are no longer in the config, or all of them
+# if rebind is set, and opens listeners for every port mapping which has none. Returns the sets of
+# opened and closed ports.
+def update_listeners(rebind=False):
+    closed = set()
+    for fd in list(listening_ports):
+        key = listening_ports[fd]
+        if rebind or key not in port_mapping:
+            close_listener(fd)
+            closed.add(key)
+    # Mappings whose listeners could not be opened by an earlier reload are tried again.
+    opened = set()
+    listening = set(listening_ports.values())
+    for key in port_mapping:
+        if key in listening:
+            continue
+        try:
+            open_listeners(key)
+            opened.add(key)
+        except OSError as error:
+            print(f"Unable to listen on port {key}: {error}", file=sys.stderr)
+    return opened, closed
 
 
-def create_two_way_communication(external, internal):
-    communication_map[external.fileno()] = (external, internal)
-    communication_map[internal.fileno()] = (internal, external)
+# A control channel lets other threads and signal handlers wake up a loop which is waiting in epoll.
+# Messages are queued with send(), which also makes the channel's file descriptor readable, and the loop
+# takes them with receive() once its epoll object reports the file descriptor. An eventfd is used where
+# available, and a pipe otherwise.
+class ControlChannel:
 
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self.write_fd = self.fd
+        else:
+            self.fd, self.write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.messages = collections.deque()
 
-def communication_thread_shutdown():
-    for key in communication_map:
-        communication_map[key][0].close()
-    io.close()
+    def send(self, message):
+        self.messages.append(message)
+        try:
+            # An eventfd only accepts 8 byte writes.
+            os.write(self.write_fd, (1).to_bytes(8, sys.byteorder))
+        except BlockingIOError:
+            # The channel is already readable.
+            pass
+
+    # This method returns the queued messages in the order they were sent.
+    def receive(self):
+        try:
+            os.read(self.fd, 4096)
+        except BlockingIOError:
+            pass
+        messages = []
+        while self.messages:
+            messages.append(self.messages.popleft())
+        return messages
+
+    def close(self):
+        os.close(self.fd)
+        if self.write_fd != self.fd:
+            os.close(self.write_fd)
+
+
+# A hashed timer wheel keeps any number of timers with constant time scheduling and cancelling. A timer
+# is identified by a key and placed in the slot of the tick its deadline falls into, so finding the
+# expired timers only looks at the slots of the ticks which have passed since the last call to expire().
+class TimerWheel:
+
+    def __init__(self):
+        self.slots = [{} for x in range(TIMER_SLOTS)]
+        # Holds the slot of every timer where:
+        #   key = timer key, value = slot index.
+        self.timers = {}
+        # Last tick which has been looked at by expire().
+        self.current = int(time.monotonic() / TIMER_TICK)
+        # No timer is due before this time, so expire() and timeout() can return right away.
+        self.earliest = float('inf')
+
+    def __len__(self):
+        return len(self.timers)
+
+    # This method schedules the timer with the given key, replacing any timer with the same key.
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        # A deadline in a tick which has already passed goes into the current slot.
+        index = max(int(deadline / TIMER_TICK), self.current) % TIMER_SLOTS
+        self.slots[index][key] = deadline
+        self.timers[key] = index
+        self.earliest = min(self.earliest, deadline)
+
+    def cancel(self, key):
+        index = self.timers.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    # This method removes the timers which are due and returns their keys.
+    def expire(self, now):
+        if now < self.earliest:
+            return []
+        expired = []
+        last = int(now / TIMER_TICK)
+        # After a long pause every slot is looked at once.
+        for tick in range(max(self.current, last - TIMER_SLOTS + 1), last + 1):
+            slot = self.slots[tick % TIMER_SLOTS]
+            for key in [key for key in slot if slot[key] <= now]:
+                del slot[key]
+                del self.timers[key]
+                expired.append(key)
+        # The current tick is looked at again, it may still hold timers which are due later in the tick.
+        self.current = last
+        self.earliest = float('inf')
+        if self.timers:
+            # The first slot with a timer may only hold timers of a later turn of the wheel, so the
+            # next deadline is either in that slot or after the end of its tick.
+            for tick in range(last, last + TIMER_SLOTS):
+                slot = self.slots[tick % TIMER_SLOTS]
+                if slot:
+                    self.earliest = min(min(slot.values()), (tick + 1) * TIMER_TICK)
+                    break
+        return expired
+
+    # This method returns the number of seconds until the next timer may be due, or -1 if there is no timer.
+    def timeout(self, now):
+        if self.earliest == float('inf'):
+            return -1
+        return max(0, self.earliest - now)
+
+
+# A relay shard owns a disjoint set of established connection pairs, and relays their data
+# in its own thread using its own epoll object.
+class RelayShard:
+
+    def __init__(self):
+        # Epoll object to handle file descriptors currently involved in an established connection.
+        self.io = select.epoll()
+        # Holds all connections of this shard.
+        self.communication_map = {}
+        # Holds data that could not be sent immediately where:
+        #   key = file descriptor of the destination socket, value = bytearray of unsent data.
+        self.out_buffers = {}
+        # Holds the events each file descriptor is currently registered for in the io epoll object, or None
+        # once it has been unregistered because nothing is left to read from or write to it.
+        self.io_events = {}
+        # File descriptors which are not being read from because their peer's output buffer is full.
+        self.paused = set()
+        # File descriptors which have reached the end of their data and are not read from any more. The end
+        # is passed on to the peer with a shutdown once everything before it has been sent.
+        self.finished = set()
+        # File descriptors whose sending side has been shut down. A pair is closed once both of its sockets
+        # are in here, as nothing is left to relay in either direction then.
+        self.shut_down = set()
+        # Holds the pipe used by the splice engine where:
+        #   key = file descriptor of the destination socket, value = (pipe read end, pipe write end).
+        self.pipes = {}
+        # Holds the number of bytes waiting inside each pipe where:
+        #   key = file descriptor of the destination socket, value = number of bytes in the pipe.
+        self.pipe_pending = {}
+        # Holds the external port of the port mapping each connection belongs to where:
+        #   key = socket file descriptor, value = external facing port on port forwarder.
+        self.connection_ports = {}
+        # Holds the backend each connection is forwarded to where:
+        #   key = socket file descriptor, value = backend dictionary.
+        self.connection_backends = {}
+        # Holds the key of the traffic counter for the data received from each socket where:
+        #   key = socket file descriptor, value = (external port, backend name, direction).
+        self.traffic_keys = {}
+        # Holds the number of bytes relayed where:
+        #   key = (external port, backend name, direction), value = number of bytes.
+        # Only this shard's thread writes these counters, so counting a read costs no lock.
+        self.traffic = {}
+        # Holds the number of connections closed because of a socket error where:
+        #   key = external facing port on port forwarder, value = number of connections.
+        self.relay_errors = {}
+        # Holds reusable receive buffers so that the relay does not allocate a new object for every read where:
+        #   key = buffer size, value = list of free bytearrays of that size.
+        self.buffer_pool = {}
+        # Number of times a buffer was taken from the pool, and number of times one had to be allocated.
+        self.buffer_pool_hits = 0
+        self.buffer_pool_misses = 0
+        # Flags added to the events of every file descriptor registered in the io epoll object.
+        if edge_triggered:
+            self.event_flags = select.EPOLLET | select.EPOLLRDHUP
+        else:
+            self.event_flags = 0
+        # File descriptors which used up their quantum before they were drained. Edge-triggered
+        # epoll will not report them again, so they are read again on the next loop iteration.
+        self.ready_to_read = set()
+        # Number of times the io epoll object has been polled.
+        self.poll_calls = 0
+        # Time at which the io epoll object last returned.
+        self.now = time.monotonic()
+        # Idle and lifetime timers of the connection pairs, keyed by ('idle', fd) and ('lifetime', fd) with
+        # the file descriptor of the external socket, and the timers of throttled sockets.
+        self.timers = TimerWheel()
+        # Holds the time each socket was last read from where:
+        #   key = socket file descriptor, value = time.
+        self.last_read = {}
+        # File descriptors which are not being read from because of a bandwidth limit. Each has a
+        # ('throttle', fd) timer which registers it for EPOLLIN again.
+        self.throttled = set()
+        # Token buckets of the connection_bandwidth option where:
+        #   key = file descriptor of the external socket, value = [bytes, time of last update].
+        self.connection_buckets = {}
+        # Holds the number of times reading was deferred by a bandwidth limit where:
+        #   key = external facing port on port forwarder, value = number of times.
+        self.throttled_reads = {}
+        # Holds the number of connection pairs closed by a timeout where:
+        #   key = (external facing port on port forwarder, 'idle' or 'lifetime'), value = number of pairs.
+        self.timeouts = {}
+        # Receives the messages of the main thread:
+        #   ('connection', external socket, internal socket, port, backend): relay a new connection pair.
+        #   ('detach', ports): detach the idle pairs of the ports into detached_pairs and set detach_done,
+        #                      this is used to hand them to a new process during an upgrade.
+        #   ('stop',): close every connection and end the thread.
+        self.control = ControlChannel()
+        self.io.register(self.control.fd, select.EPOLLIN)
+        self.detached_pairs = []
+        self.detach_done = threading.Event()
+        self.thread = threading.Thread(target=self.communication_thread)
+
+    # This method returns the number of connection pairs relayed by this shard, including new pairs which
+    # have been sent to the shard but not yet registered.
+    def load(self):
+        return len(self.communication_map) // 2 + len(self.control.messages)
+
+    # This method starts relaying a connection pair which was sent by the main thread.
+    def register_connection(self, external, internal, port, backend):
+        # Once both connections are made, pass the sockets into the create_two_way_communication function.
+        self.create_two_way_communication(external, internal, port, backend)
+        # Once two way communication data structure is established, register the sockets into the
+        # data transfer epoll object of the shard.
+        self.io.register(internal.fileno(), select.EPOLLIN | self.event_flags)
+        self.io.register(external.fileno(), select.EPOLLIN | self.event_flags)
+        now = time.monotonic()
+        options = mapping_options[port]
+        if options['idle_timeout']:
+            self.timers.schedule(('idle', external.fileno()), now + options['idle_timeout'])
+        if options['max_lifetime']:
+            self.timers.schedule(('lifetime', external.fileno()), now + options['max_lifetime'])
+
+    def create_two_way_communication(self, external, internal, port, backend):
+        self.communication_map[external.fileno()] = (external, internal)
+        self.communication_map[internal.fileno()] = (internal, external)
+        self.out_buffers[external.fileno()] = bytearray()
+        self.out_buffers[internal.fileno()] = bytearray()
+        self.io_events[external.fileno()] = select.EPOLLIN | self.event_flags
+        self.io_events[internal.fileno()] = select.EPOLLIN | self.event_flags
+        self.connection_ports[external.fileno()] = port
+        self.connection_ports[internal.fileno()] = port
+        self.connection_backends[external.fileno()] = backend
+        self.connection_backends[internal.fileno()] = backend
+        self.traffic_keys[external.fileno()] = (port, backend['name'], 'in')
+        self.traffic_keys[internal.fileno()] = (port, backend['name'], 'out')
+        for sock in (external, internal):
+            self.traffic.setdefault(self.traffic_keys[sock.fileno()], 0)
+            self.last_read[sock.fileno()] = self.now
+        # The splice engine needs one pipe for each direction of the connection. If the pipes can't be
+        # created, usually because the process is out of file descriptors, the pair uses the copy engine.
+        if mapping_options[port].get('engine') == 'splice':
+            pipes = []
+            try:
+                for sock in (external, internal):
+                    pipes.append(os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC))
+            except OSError as error:
+                for pipe in pipes:
+                    os.close(pipe[0])
+                    os.close(pipe[1])
+                print(f"Unable to create splice pipes on port {port}, using the copy engine: {error.strerror}",
+                      file=sys.stderr)
+                return
+            for sock, pipe in zip((external, internal), pipes):
+                self.pipes[sock.fileno()] = pipe
+                self.pipe_pending[sock.fileno()] = 0
+
+    # This method removes a connection pair from every data structure and closes both sockets.
+    def close_two_way_communication(self, fd):
+        for sock in self.remove_two_way_communication(fd):
+            sock.close()
+        if not quiet:
+            print("Connection Closed")
+        # Tell a draining main loop that this shard may have finished.
+        if draining and not self.communication_map:
+            main_control.send(('idle',))
+
+    # This method removes a connection pair from every data structure without closing its sockets,
+    # and returns the two sockets.
+    def remove_two_way_communication(self, fd):
+        read, write = self.communication_map[fd]
+        release_backend(self.connection_backends[fd])
+        for sock in (read, write):
+            sock_fd = sock.fileno()
+            del self.communication_map[sock_fd]
+            del self.out_buffers[sock_fd]
+            events = self.io_events.pop(sock_fd)
+            del self.connection_ports[sock_fd]
+            del self.connection_backends[sock_fd]
+            del self.traffic_keys[sock_fd]
+            del self.last_read[sock_fd]
+            release_client(sock_fd)
+            self.timers.cancel(('idle', sock_fd))
+            self.timers.cancel(('lifetime', sock_fd))
+            self.timers.cancel(('throttle', sock_fd))
+            self.connection_buckets.pop(sock_fd, None)
+            self.throttled.discard(sock_fd)
+            self.paused.discard(sock_fd)
+            self.finished.discard(sock_fd)
+            self.shut_down.discard(sock_fd)
+            self.ready_to_read.discard(sock_fd)
+            if sock_fd in self.pipes:
+                os.close(self.pipes[sock_fd][0])
+                os.close(self.pipes[sock_fd][1])
+                del self.pipes[sock_fd]
+                del self.pipe_pending[sock_fd]
+            if events is not None:
+                self.io.unregister(sock_fd)
+        return read, write
+
+    # This method removes the pairs of the given ports which have nothing buffered and are not paused
+    # or half closed, and returns them as a list of (external socket, internal socket, port, backend). Data
+    # which arrives after this is left in the sockets for the process which takes the pairs over.
+    def detach_idle_pairs(self, ports):
+        pairs = []
+        for fd in list(self.communication_map):
+            # Every pair is visited once, from its external socket.
+            if fd not in self.communication_map or self.traffic_keys[fd][2] != 'in':
+                continue
+            port = self.connection_ports[fd]
+            internal_fd = self.communication_map[fd][1].fileno()
+            if port not in ports or any(self.pending_bytes(sock_fd) or sock_fd in self.paused or sock_fd in self.finished
+                                        or sock_fd in self.ready_to_read for sock_fd in (fd, internal_fd)):
+                continue
+            backend = self.connection_backends[fd]
+            external, internal = self.remove_two_way_communication(fd)
+            pairs.append((external, internal, port, backend))
+        return pairs
+
+    # This method returns the number of bytes waiting to be sent to the file descriptor.
+    def pending_bytes(self, fd):
+        if fd in self.pipes:
+            return self.pipe_pending[fd]
+        return len(self.out_buffers[fd])
+
+    # This method registers the file descriptor for EPOLLIN unless reading is paused, throttled or the
+    # socket has finished sending, and for EPOLLOUT only while there is data waiting to be sent.
+    def update_events(self, fd):
+        events = self.event_flags
+        if fd not in self.paused and fd not in self.finished and fd not in self.throttled:
+            events |= select.EPOLLIN
+        if self.pending_bytes(fd):
+            events |= select.EPOLLOUT
+        if self.io_events[fd] is not None and self.io_events[fd] != events:
+            self.io.modify(fd, events)
+            self.io_events[fd] = events
+
+    # This method sends as much of the data as the socket will accept, and keeps the rest in
+    # the socket's output buffer. Returns False if the connection has failed.
+    def queue_send(self, sock, data):
+        fd = sock.fileno()
+        buffer = self.out_buffers[fd]
+        if not buffer:
+            try:
+                sent = sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                return False
+            data = data[sent:]
+        buffer += data
+        self.update_events(fd)
+        return True
+
+    # This method is called once the file descriptor has reached the end of its data. It is not read from
+    # any more, and the other direction of the pair is still relayed. The end is passed on to the peer once
+    # whatever is still waiting to be sent to it has been flushed.
+    def finish_reading(self, fd):
+        read, write = self.communication_map[fd]
+        self.finished.add(fd)
+        self.update_events(fd)
+        if not self.pending_bytes(write.fileno()):
+            self.shutdown_output(write.fileno())
+
+    # This method shuts down the sending side of the socket after its peer has finished and everything it
+    # sent has been flushed. The pair is closed once both directions have been shut down.
+    def shutdown_output(self, fd):
+        read, write = self.communication_map[fd]
+        try:
+            read.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.close_with_error(fd)
+            return
+        self.shut_down.add(fd)
+        if write.fileno() in self.shut_down:
+            self.close_two_way_communication(fd)
+
+    # This method closes the pair because of a socket error, and counts the error.
+    def close_with_error(self, fd):
+        port = self.connection_ports[fd]
+        self.relay_errors[port] = self.relay_errors.get(port, 0) + 1
+        self.close_two_way_communication(fd)
+
+    # This method takes a buffer of the given size from the pool, or allocates one if the pool is empty.
+    def acquire_buffer(self, size):
+        free = self.buffer_pool.get(size)
+        if free:
+            self.buffer_pool_hits += 1
+            return free.pop()
+        self.buffer_pool_misses += 1
+        return bytearray(size)
+
+    # This method returns a buffer to the pool so that it can be reused by the next read.
+    def release_buffer(self, buffer):
+        free = self.buffer_pool.setdefault(len(buffer), [])
+        if len(free) < BUFFER_POOL_LIMIT:
+            free.append(buffer)
+
+    # This method reads at most size bytes once from the socket and forwards the data to its peer.
+    # Returns the number of bytes received, or 0 if nothing was received.
+    def relay_read(self, fd, size):
+        read, write = self.communication_map[fd]
+        buffer = self.acquire_buffer(mapping_options[self.connection_ports[fd]]['read_size'])
+        # Receive the data into the buffer and forward to the corresponding destination.
+        try:
+            received = read.recv_into(buffer, min(size, len(buffer)))
+        except BlockingIOError:
+            self.release_buffer(buffer)
+            return 0
+        except OSError:
+            self.release_buffer(buffer)
+            self.close_with_error(fd)
+            return 0
+        with memoryview(buffer) as view, view[:received] as data:
+            finished = received == 0 or data == b"quit\n"
+            # Anything the destination does not accept right away is copied into its output buffer.
+            sent = finished or self.queue_send(write, data)
+        self.release_buffer(buffer)
+        if finished:
+            self.finish_reading(fd)
+            return 0
+        if not sent:
+            self.close_with_error(fd)
+            return 0
+        self.traffic[self.traffic_keys[fd]] += received
+        # Stop reading from this socket while its peer is not keeping up.
+        if len(self.out_buffers[write.fileno()]) >= HIGH_WATERMARK:
+            self.paused.add(fd)
+            self.update_events(fd)
+        return received
+
+    def relay_write(self, fd):
+        read, write = self.communication_map[fd]
+        buffer = self.out_buffers[fd]
+        try:
+            sent = read.send(buffer)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_with_error(fd)
+            return
+        del buffer[:sent]
+        self.update_events(fd)
+        if not buffer and write.fileno() in self.finished:
+            self.shutdown_output(fd)
+            return
+        # Resume reading from the peer once the buffer has drained.
+        if write.fileno() in self.paused and len(buffer) < LOW_WATERMARK:
+            self.paused.discard(write.fileno())
+            self.update_events(write.fileno())
+
+    # This method moves as much data as possible out of the pipe into the destination socket.
+    # Returns False if the connection has failed.
+    def flush_pipe(self, fd):
+        try:
+            sent = os.splice(self.pipes[fd][0], fd, self.pipe_pending[fd],
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            return False
+        self.pipe_pending[fd] -= sent
+        self.update_events(fd)
+        return True
+
+    # This method is the splice engine version of relay_read. The data is moved from the socket
+    # into the pipe of the destination socket and from there into the destination socket, without
+    # ever being copied into Python. Returns the number of bytes received like relay_read.
+    def splice_read(self, fd, size):
+        read, write = self.communication_map[fd]
+        write_fd = write.fileno()
+        try:
+            received = os.splice(fd, self.pipes[write_fd][1], min(size, SPLICE_SIZE),
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return 0
+        except OSError:
+            self.close_with_error(fd)
+            return 0
+        if received == 0:
+            self.finish_reading(fd)
+            return 0
+        self.traffic[self.traffic_keys[fd]] += received
+        self.pipe_pending[write_fd] += received
+        if not self.flush_pipe(write_fd):
+            self.close_with_error(fd)
+            return 0
+        # A full pipe cannot be told apart from an empty socket, so stop reading from this
+        # socket until the pipe has been emptied.
+        if self.pipe_pending[write_fd]:
+            self.paused.add(fd)
+            self.update_events(fd)
+        return received
+
+    def splice_write(self, fd):
+        read, write = self.communication_map[fd]
+        if not self.flush_pipe(fd):
+            self.close_with_error(fd)
+            return
+        if self.pipe_pending[fd]:
+            return
+        if write.fileno() in self.finished:
+            self.shutdown_output(fd)
+        elif write.fileno() in self.paused:
+            self.paused.discard(write.fileno())
+            self.update_events(write.fileno())
+
+    # This method charges the bytes received from the socket to the bandwidth limits of its pair and
+    # mapping. Once a limit has been used up the socket is not read from until a timer lets it be read
+    # again, the data meanwhile waits in the kernel. Returns True if the socket has been throttled.
+    def throttle_reading(self, fd, received):
+        port = self.connection_ports[fd]
+        options = mapping_options[port]
+        delay = 0
+        if options['connection_bandwidth']:
+            # Both directions of a pair share the bucket of the external socket.
+            read, write = self.communication_map[fd]
+            key = fd if self.traffic_keys[fd][2] == 'in' else write.fileno()
+            bucket = self.connection_buckets.setdefault(key, [options['connection_bandwidth'], self.now])
+            delay = charge_bucket(bucket, options['connection_bandwidth'], received, self.now)
+        if options['bandwidth']:
+            with bandwidth_lock:
+                bucket = mapping_buckets.setdefault(port, [options['bandwidth'], self.now])
+                delay = max(delay, charge_bucket(bucket, options['bandwidth'], received, self.now))
+        if not delay:
+            return False
+        self.throttled_reads[port] = self.throttled_reads.get(port, 0) + 1
+        self.throttled.add(fd)
+        self.update_events(fd)
+        self.timers.schedule(('throttle', fd), self.now + delay)
+        return True
+
+    # This method is called when the socket is readable. In edge-triggered mode the socket is read
+    # until it would block, its reading is paused or throttled, or it has used up its quantum. In
+    # level-triggered mode it is read once, epoll reports it again if there is data left.
+    def handle_readable(self, fd):
+        self.last_read[fd] = self.now
+        read = self.splice_read if fd in self.pipes else self.relay_read
+        options = mapping_options[self.connection_ports[fd]]
+        # Reading only stops at a bandwidth limit when the mapping has one.
+        limited = options['bandwidth'] or options['connection_bandwidth']
+        # A socket which stops early does not save up the rest of its quantum.
+        quantum = options['quantum']
+        while quantum > 0:
+            received = read(fd, quantum)
+            if received == 0 or fd not in self.communication_map or fd in self.paused or fd in self.finished:
+                return
+            if limited and self.throttle_reading(fd, received):
+                return
+            if not edge_triggered:
+                return
+            quantum -= received
+        self.ready_to_read.add(fd)
+
+    # This method returns the priority of the mapping the socket belongs to.
+    def priority(self, fd):
+        return mapping_options[self.connection_ports[fd]]['priority']
+
+    def handle_writable(self, fd):
+        if fd in self.pipes:
+            self.splice_write(fd)
+        else:
+            self.relay_write(fd)
+
+    # This method handles the timers which are due. An idle timer is only a first guess, the pair is closed
+    # if neither socket has been read from since, and the timer is scheduled again otherwise. A throttle
+    # timer registers its socket for EPOLLIN again, which makes epoll report it if data is waiting even
+    # in edge-triggered mode.
+    def expire_timers(self):
+        for kind, fd in self.timers.expire(self.now):
+            # The pair may already have been closed by an earlier timer in this batch.
+            if fd not in self.communication_map:
+                continue
+            if kind == 'throttle':
+                self.throttled.discard(fd)
+                self.update_events(fd)
+                continue
+            read, write = self.communication_map[fd]
+            port = self.connection_ports[fd]
+            if kind == 'idle':
+                idle_timeout = mapping_options[port]['idle_timeout']
+                last_read = max(self.last_read[fd], self.last_read[write.fileno()])
+                if last_read + idle_timeout > self.now:
+                    self.timers.schedule(('idle', fd), last_read + idle_timeout)
+                    continue
+            self.timeouts[(port, kind)] = self.timeouts.get((port, kind), 0) + 1
+            self.close_two_way_communication(fd)
+
+    def communication_thread_shutdown(self):
+        for key in self.communication_map:
+            self.communication_map[key][0].close()
+        self.io.close()
+        self.control.close()
+        print(f"Buffer pool: {self.buffer_pool_hits} hits, {self.buffer_pool_misses} misses")
+        print(f"Relay poll calls: {self.poll_calls}")
+
+    def communication_thread(self):
+        print(f"Two-Way Communication Thread Started ({self.thread.name})")
+        readable = select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLHUP | select.EPOLLERR
+        while True:
+            # Wait until there is something to do or a timer is due, but don't wait while there are sockets
+            # left to read from.
+            events = self.io.poll(0 if self.ready_to_read else self.timers.timeout(time.monotonic()))
+            self.poll_calls += 1
+            self.now = time.monotonic()
+            # Sockets which used up their quantum in the last iteration are read after the new events.
+            ready = self.ready_to_read
+            self.ready_to_read = set()
+            readable_fds = []
+            for fd, event in events:
+                if fd == self.control.fd:
+                    for message in self.control.receive():
+                        if message[0] == 'connection':
+                            self.register_connection(*message[1:])
+                        elif message[0] == 'detach':
+                            self.detached_pairs = self.detach_idle_pairs(message[1])
+                            self.detach_done.set()
+                        elif message[0] == 'stop':
+                            # Shutdown when main thread signals.
+                            self.communication_thread_shutdown()
+                            return
+                # The pair may already have been closed by an earlier event in this batch. Data is sent
+                # right away, reading waits until every readable socket of the iteration is known.
+                if fd in self.communication_map and event & select.EPOLLOUT:
+                    self.handle_writable(fd)
+                if fd in self.communication_map and event & readable:
+                    ready.discard(fd)
+                    if fd not in self.finished:
+                        readable_fds.append(fd)
+                    elif event & select.EPOLLERR or (event & select.EPOLLHUP and fd not in self.shut_down):
+                        # The socket has failed, nothing more can be sent to it.
+                        self.close_with_error(fd)
+                    elif event & select.EPOLLHUP:
+                        # Both directions of the socket have ended normally. The hang up can't be masked,
+                        # so the socket is no longer polled while its peer is still being sent to.
+                        self.io.unregister(fd)
+                        self.io_events[fd] = None
+            for fd in ready:
+                if fd in self.communication_map and fd not in self.paused and fd not in self.finished \
+                        and fd not in self.throttled:
+                    readable_fds.append(fd)
+            # The sort is stable, so sockets with the same priority keep their order.
+            if len(readable_fds) > 1:
+                readable_fds = [fd for fd in readable_fds if fd in self.communication_map]
+                readable_fds.sort(key=self.priority, reverse=True)
+            for fd in readable_fds:
+                if fd in self.communication_map:
+                    self.handle_readable(fd)
+            self.expire_timers()
 
 
 def main_thread_shutdown():
     for key in listening_socket_list:
         listening_socket_list[key].close()
+    for key in list(pending_connections):
+        external_conn, internal_conn, deadline, port, backend = pending_connections.pop(key)
+        fail_pending_connection(external_conn, internal_conn, backend)
+    for key in mapping_backends:
+        for backend in mapping_backends[key]:
+            for sock, connected in backend['idle']:
+                sock.close()
+            backend['idle'] = []
+    close_upgrade_socket()
+    main_control.close()
     multiplexor.close()
 
 
-def communication_thread():
-    print("Two-Way Communication Thread Started")
-    while running:
-        events = io.poll(1)
-        for fd, event in events:
-            if event & select.EPOLLIN:
-                read, write = communication_map[fd]
-                # Receive the data and forward to the corresponding destination.
+# This function starts a non-blocking connection to the backend, and returns the socket together
+# with the result of connect_ex.
+def start_backend_connection(backend):
+    internal_conn = socket.socket(backend['family'], socket.SOCK_STREAM)
+    internal_conn.setblocking(0)
+    return internal_conn, internal_conn.connect_ex(backend['address'])
+
+
+# This function closes the sockets of a connection to the internal host which has failed.
+def fail_pending_connection(external_conn, internal_conn, backend):
+    record_failure(backend)
+    backend['connect_failures'] += 1
+    internal_conn.close()
+    if external_conn is None:
+        backend['warming'] -= 1
+    else:
+        release_backend(backend)
+        release_client(external_conn.fileno())
+        external_conn.close()
+
+
+# This function checks that an idle connection has not been closed by the internal host. Data sent
+# by the internal host is left in the socket and relayed once a client is paired with it.
+def connection_alive(sock):
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b""
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+# This function returns an idle connection from the warm pool of the backend, or None if there is no
+# usable one. Connections which are too old or which have been closed are thrown away.
+def take_warm_connection(backend, port):
+    oldest = time.monotonic() - mapping_options[port]['warm_pool_idle']
+    while backend['idle']:
+        sock, connected = backend['idle'].pop()
+        if connected >= oldest and connection_alive(sock):
+            return sock
+        sock.close()
+    return None
+
+
+# This function closes idle connections which are too old, and starts new connections to every
+# backend whose warm pool is not full.
+def refill_warm_pools():
+    now = time.monotonic()
+    for key in mapping_backends:
+        size = mapping_options[key]['warm_pool']
+        if size == 0:
+            continue
+        oldest = now - mapping_options[key]['warm_pool_idle']
+        for backend in mapping_backends[key]:
+            if backend['state'] == 'down':
+                continue
+            for sock, connected in backend['idle']:
+                if connected < oldest:
+                    sock.close()
+            backend['idle'] = [(sock, connected) for sock, connected in backend['idle'] if connected >= oldest]
+            for x in range(size - len(backend['idle']) - backend['warming']):
                 try:
-                    data = read.recv(1024)
-                except ConnectionResetError:
-                    pass
-                if data == b"" or data == b"quit\n":
-                    del communication_map[read.fileno()]
-                    del communication_map[write.fileno()]
-                    io.unregister(read.fileno())
-                    io.unregister(write.fileno())
-                    read.close()
-                    write.close()
-                    print("Connection Closed")
+                    internal_conn, result = start_backend_connection(backend)
+                except OSError as error:
+                    print(f"Unable to connect to internal host {backend['address']}: {error.strerror}",
+                          file=sys.stderr)
+                    break
+                if result == 0:
+                    record_success(backend)
+                    backend['idle'].append((internal_conn, now))
+                elif result == errno.EINPROGRESS:
+                    backend['warming'] += 1
+                    add_pending_connection(None, internal_conn, key, backend)
                 else:
-                    write.send(data)
-    # Shutdown when main thread signals.
-    communication_thread_shutdown()
+                    record_failure(backend)
+                    internal_conn.close()
+                    break
+
+
+# This function accepts a new external connection and starts a non-blocking connection
+# to the internal host. The pair is only handed to the communication thread once the
+# connection to the internal host has been established. Returns False once there are no
+# more connections waiting to be accepted.
+def accept_connection(fd):
+    try:
+        external_conn, addr = listening_socket_list[fd].accept()
+    except BlockingIOError:
+        return False
+    except ConnectionAbortedError:
+        return True
+    except OSError as error:
+        # Out of file descriptors or buffer space, the connection stays in the backlog until then.
+        print(f"Unable to accept connection on port {listening_ports[fd]}: {error.strerror}", file=sys.stderr)
+        pause_listener(fd)
+        return False
+    external_conn.setblocking(0)
+    # The port is taken from the listening socket, so no getsockname call is needed per connection.
+    port = listening_ports[fd]
+    accepted_connections[port] = accepted_connections.get(port, 0) + 1
+    reason = admit_connection(external_conn.fileno(), port, addr[0])
+    if reason is not None:
+        if not quiet:
+            print(f"Connection from external host {addr} to port {port} rejected by {reason}", file=sys.stderr)
+        reject_connection(external_conn, port, reason)
+        return True
+    # Once the connection is established between the pf and the external host, create the subsequent
+    # connection between the pf and the internal host chosen for this port mapping.
+    backend = choose_backend(port, external_conn.family)
+    if backend is None:
+        print(f"No internal host available for port {port}", file=sys.stderr)
+        release_client(external_conn.fileno())
+        external_conn.close()
+        return True
+    internal_address = backend['address']
+    if not quiet:
+        print(f"Connection from external host {addr} to port {port}, forwarding to internal host {internal_address}")
+    # Use an idle connection from the warm pool if there is one.
+    internal_conn = take_warm_connection(backend, port)
+    if internal_conn is not None:
+        establish_connection(external_conn, internal_conn, port, backend)
+        return True
+    try:
+        internal_conn, result = start_backend_connection(backend)
+    except OSError as error:
+        print(f"Unable to connect to internal host {internal_address}: {error.strerror}", file=sys.stderr)
+        release_backend(backend)
+        release_client(external_conn.fileno())
+        external_conn.close()
+        pause_listener(fd)
+        return False
+    if result == 0:
+        record_success(backend)
+        establish_connection(external_conn, internal_conn, port, backend)
+    elif result == errno.EINPROGRESS:
+        # The internal host has not answered yet, wait for the socket to become writable.
+        add_pending_connection(external_conn, internal_conn, port, backend)
+    else:
+        print(f"Unable to connect to internal host {internal_address}: {os.strerror(result)}", file=sys.stderr)
+        fail_pending_connection(external_conn, internal_conn, backend)
+    return True
+
+
+# This function accepts the connections waiting on a listening socket. In edge-triggered mode the
+# listening socket is only reported again once a new connection arrives, so the backlog is drained
+# completely, otherwise at most ACCEPT_BATCH connections are accepted per event.
+def accept_connections(fd):
+    count = 0
+    while accept_connection(fd):
+        count += 1
+        if not edge_triggered and count >= ACCEPT_BATCH:
+            break
+
+
+# This function is called once a pending connection to the internal host becomes writable,
+# and checks whether the connection succeeded or failed.
+def complete_connection(fd):
+    external_conn, internal_conn, deadline, port, backend = pending_connections.pop(fd)
+    multiplexor.unregister(fd)
+    connect_timers.cancel(fd)
+    result = internal_conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if result != 0:
+        print(f"Unable to connect to internal host {backend['address']}: {os.strerror(result)}", file=sys.stderr)
+        fail_pending_connection(external_conn, internal_conn, backend)
+        return
+    record_success(backend)
+    if external_conn is None:
+        # The connection was made for the warm pool.
+        backend['warming'] -= 1
+        if backend['removed'] or draining:
+            internal_conn.close()
+        else:
+            backend['idle'].append((internal_conn, time.monotonic()))
+        return
+    establish_connection(external_conn, internal_conn, port, backend)
+
+
+# This function waits for a connection to the internal host to be established, until the connect timeout
+# of the port mapping has passed.
+def add_pending_connection(external_conn, internal_conn, port, backend):
+    connect_timeout = mapping_options[port]['connect_timeout']
+    deadline = time.monotonic() + connect_timeout if connect_timeout else None
+    pending_connections[internal_conn.fileno()] = (external_conn, internal_conn, deadline, port, backend)
+    if deadline is not None:
+        connect_timers.schedule(internal_conn.fileno(), deadline)
+    multiplexor.register(internal_conn.fileno(), select.EPOLLOUT)
+
+
+# This function closes every pending connection whose connect timeout has passed.
+def expire_pending_connections():
+    for fd in connect_timers.expire(time.monotonic()):
+        external_conn, internal_conn, deadline, port, backend = pending_connections.pop(fd)
+        multiplexor.unregister(fd)
+        print(f"Connection to internal host {backend['address']} timed out after "
+              f"{mapping_options[port]['connect_timeout']} seconds", file=sys.stderr)
+        connect_timeouts[port] = connect_timeouts.get(port, 0) + 1
+        fail_pending_connection(external_conn, internal_conn, backend)
+
+
+def establish_connection(external_conn, internal_conn, port, backend):
+    global total_connections
+    total_connections += 1
+    backend['connections'] += 1
+    assign_connection(external_conn, internal_conn, port, backend)
 
 
-def main(thread):
+# This function hands a connection pair to the relay shard with the fewest connections. The shard's own
+# thread registers the pair, so the shard's data structures are only changed by that thread.
+def assign_connection(external_conn, internal_conn, port, backend):
+    shard = min(relay_shards, key=RelayShard.load)
+    shard.control.send(('connection', external_conn, internal_conn, port, backend))
+
+
+# This function relays a connection pair which was established by another process, or which has been
+# taken back from a failed upgrade.
+def adopt_connection(external_conn, internal_conn, port, backend):
+    with backend_lock:
+        backend['active'] += 1
+    assign_connection(external_conn, internal_conn, port, backend)
+
+
+# Messages exchanged over the upgrade socket are JSON objects, sent together with the file descriptors
+# they describe.
+def send_message(sock, message, fds=()):
+    socket.send_fds(sock, [json.dumps(message).encode('utf-8')], list(fds))
+
+
+def receive_message(sock):
+    data, fds, flags, address = socket.recv_fds(sock, UPGRADE_MESSAGE_SIZE, UPGRADE_BATCH)
+    if not data:
+        raise ConnectionError("the other process closed the upgrade socket")
+    return json.loads(data), fds
+
+
+# This function binds the upgrade socket on which a new process can take over from this one.
+def open_upgrade_socket():
+    global upgrade_listener
+    try:
+        os.unlink(upgrade_socket)
+    except FileNotFoundError:
+        pass
+    upgrade_listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    upgrade_listener.bind(upgrade_socket)
+    upgrade_listener.listen(1)
+    multiplexor.register(upgrade_listener.fileno(), select.EPOLLIN)
+    print(f"Waiting for upgrades on {upgrade_socket}")
+
+
+def close_upgrade_socket():
+    global upgrade_listener
+    if upgrade_listener is not None:
+        multiplexor.unregister(upgrade_listener.fileno())
+        upgrade_listener.close()
+        upgrade_listener = None
+        os.unlink(upgrade_socket)
+
+
+# This function hands the listening sockets, and the idle connection pairs if they are asked for, to a new
+# process which has connected to the upgrade socket. Both processes accept connections until the new one
+# has confirmed that it is listening, then this process stops accepting and starts draining. If the new
+# process fails, this process carries on as before.
+def hand_over():
+    global upgrade_listener, metrics_server
+    successor, address = upgrade_listener.accept()
+    successor.settimeout(UPGRADE_TIMEOUT)
+    try:
+        request, fds = receive_message(successor)
+        listeners = list(listening_ports.items())
+        for start in range(0, len(listeners), UPGRADE_BATCH):
+            batch = listeners[start:start + UPGRADE_BATCH]
+            send_message(successor, {'type': 'listeners', 'ports': [port for fd, port in batch]},
+                         [fd for fd, port in batch])
+        send_message(successor, {'type': 'listeners_done'})
+        if receive_message(successor)[0]['type'] != 'listening':
+            raise ValueError("unexpected message")
+    except (OSError, ValueError, KeyError) as error:
+        print(f"Upgrade failed, keeping the listening sockets: {error}", file=sys.stderr)
+        successor.close()
+        return
+    # The metrics port is handed over as well.
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+        metrics_server = None
+    # The upgrade socket path now belongs to the new process, so it is not unlinked.
+    multiplexor.unregister(upgrade_listener.fileno())
+    upgrade_listener.close()
+    upgrade_listener = None
+    start_drain()
+    pairs = []
+    if request.get('connections'):
+        for shard in relay_shards:
+            shard.detach_done.clear()
+            shard.control.send(('detach', set(request['ports'])))
+        for shard in relay_shards:
+            if shard.detach_done.wait(UPGRADE_TIMEOUT):
+                pairs.extend(shard.detached_pairs)
+                shard.detached_pairs = []
+    try:
+        for start in range(0, len(pairs), UPGRADE_BATCH // 2):
+            batch = pairs[start:start + UPGRADE_BATCH // 2]
+            fds = []
+            for external_conn, internal_conn, port, backend in batch:
+                fds.extend((external_conn.fileno(), internal_conn.fileno()))
+            send_message(successor, {'type': 'connections',
+                                     'pairs': [[port, backend['name']] for external_conn, internal_conn, port, backend
+                                               in batch]}, fds)
+        send_message(successor, {'type': 'done'})
+        if receive_message(successor)[0]['type'] != 'done':
+            raise ValueError("unexpected message")
+    except (OSError, ValueError, KeyError) as error:
+        print(f"Upgrade failed, keeping {len(pairs)} connections: {error}", file=sys.stderr)
+        for external_conn, internal_conn, port, backend in pairs:
+            adopt_connection(external_conn, internal_conn, port, backend)
+        pairs = []
+    # The new process holds its own copies of the sockets.
+    for external_conn, internal_conn, port, backend in pairs:
+        external_conn.close()
+        internal_conn.close()
+    successor.close()
+    print(f"Handed over to the new port forwarder with {len(pairs)} connections")
+
+
+# This function takes the listening sockets, and the idle connection pairs if -C is given, over from the
+# process serving the upgrade socket. Listening sockets of ports which are not in this process's config
+# are closed, and listeners are opened for ports which were not taken over.
+def take_over():
+    predecessor = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    predecessor.settimeout(UPGRADE_TIMEOUT)
+    listeners = 0
+    adopted = 0
+    try:
+        predecessor.connect(upgrade_socket)
+        send_message(predecessor, {'connections': takeover_connections, 'ports': list(port_mapping)})
+        while True:
+            message, fds = receive_message(predecessor)
+            if message['type'] == 'listeners':
+                listeners += adopt_listeners(message['ports'], fds)
+            elif message['type'] == 'listeners_done':
+                send_message(predecessor, {'type': 'listening'})
+            elif message['type'] == 'connections':
+                for x in range(len(message['pairs'])):
+                    port, name = message['pairs'][x]
+                    adopt_handed_connection(port, name, fds[2 * x], fds[2 * x + 1])
+                    adopted += 1
+            elif message['type'] == 'done':
+                send_message(predecessor, {'type': 'done'})
+                break
+    except (OSError, ValueError, KeyError) as error:
+        print(f"Unable to take over from {upgrade_socket}: {error}", file=sys.stderr)
+    predecessor.close()
+    update_listeners()
+    print(f"Took over {listeners} listening sockets and {adopted} connections")
+
+
+# This function registers the listening sockets handed over by the old process, and returns how many of
+# them are used.
+def adopt_listeners(ports, fds):
+    adopted = 0
+    for port, fd in zip(ports, fds):
+        sock = socket.socket(fileno=fd)
+        host = server_host_ipv4 if sock.family == socket.AF_INET else server_host_ipv6
+        if port not in port_mapping or ipaddress.ip_address(sock.getsockname()[0]) != ipaddress.ip_address(host):
+            sock.close()
+            continue
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, mapping_options[port]['defer_accept'])
+        register_listener(sock, port)
+        adopted += 1
+    return adopted
+
+
+# This function relays a connection pair handed over by the old process. A pair whose internal host is not
+# in this process's config keeps relaying to it, but no new connection is forwarded there.
+def adopt_handed_connection(port, name, external_fd, internal_fd):
+    external_conn = socket.socket(fileno=external_fd)
+    internal_conn = socket.socket(fileno=internal_fd)
+    for backend in mapping_backends.get(port, []):
+        if backend['name'] == name:
+            break
+    else:
+        host, separator, backend_port = name.rpartition(':')
+        backend = new_backend(host.strip('[]'), int(backend_port), 1)
+        backend['removed'] = True
+    adopt_connection(external_conn, internal_conn, port, backend)
+
+
+# This function returns the statistics of this process which are reported to the supervisor.
+def collect_statistics():
+    return {
+        'pid': os.getpid(),
+        'total_connections': total_connections,
+        'active_connections': sum(shard.load() for shard in relay_shards),
+        'pending_connections': len(pending_connections),
+        'buffer_pool_hits': sum(shard.buffer_pool_hits for shard in relay_shards),
+        'buffer_pool_misses': sum(shard.buffer_pool_misses for shard in relay_shards),
+        'poll_calls': sum(shard.poll_calls for shard in relay_shards),
+        'metrics': collect_metrics(),
+    }
+
+
+# This function returns the current value of every metric as a list of (name, labels, value). The
+# counters are read without locking, a value may be one update behind.
+def collect_metrics():
+    samples = []
+    for key in list(accepted_connections):
+        samples.append(('port_forwarder_accepted_connections_total', (('port', key),), accepted_connections[key]))
+    health = {'up': 1, 'recovering': 0.5, 'down': 0}
+    for key, backends in list(mapping_backends.items()):
+        for backend in backends:
+            labels = (('port', key), ('backend', backend['name']))
+            samples.append(('port_forwarder_connections_total', labels, backend['connections']))
+            samples.append(('port_forwarder_active_connections', labels, backend['active']))
+            samples.append(('port_forwarder_connect_failures_total', labels, backend['connect_failures']))
+            samples.append(('port_forwarder_backend_up', labels, health[backend['state']]))
+    for shard in relay_shards:
+        for (port, backend, direction), value in list(shard.traffic.items()):
+            samples.append(('port_forwarder_bytes_total',
+                            (('port', port), ('backend', backend), ('direction', direction)), value))
+        for port, value in list(shard.relay_errors.items()):
+            samples.append(('port_forwarder_relay_errors_total', (('port', port),), value))
+    samples.append(('port_forwarder_buffer_pool_hits_total', (), sum(shard.buffer_pool_hits for shard in relay_shards)))
+    samples.append(('port_forwarder_buffer_pool_misses_total', (),
+                    sum(shard.buffer_pool_misses for shard in relay_shards)))
+    samples.append(('port_forwarder_poll_calls_total', (), sum(shard.poll_calls for shard in relay_shards)))
+    for (port, reason), value in list(rejected_connections.items()):
+        samples.append(('port_forwarder_rejected_connections_total', (('port', port), ('reason', reason)), value))
+    for port, value in list(connect_timeouts.items()):
+        samples.append(('port_forwarder_timeouts_total', (('port', port), ('kind', 'connect')), value))
+    for shard in relay_shards:
+        for (port, kind), value in list(shard.timeouts.items()):
+            samples.append(('port_forwarder_timeouts_total', (('port', port), ('kind', kind)), value))
+        for port, value in list(shard.throttled_reads.items()):
+            samples.append(('port_forwarder_throttled_reads_total', (('port', port),), value))
+    # Samples from several relay shards can share the same labels.
+    return metrics.merge_samples([samples])
+
+
+# This function stops accepting connections, so that the main loop exits once the open connections have
+# finished or drain_timeout seconds have passed. Connections to the internal host which are still being
+# established are completed, and the warm pools are closed.
+def start_drain():
+    global draining, drain_deadline
+    for fd in list(listening_ports):
+        close_listener(fd)
+    close_upgrade_socket()
+    for key in mapping_backends:
+        for backend in mapping_backends[key]:
+            for sock, connected in backend['idle']:
+                sock.close()
+            backend['idle'] = []
+    draining = True
+    drain_deadline = time.monotonic() + drain_timeout
+    print(f"Stopped accepting connections, waiting up to {drain_timeout} seconds for "
+          f"{sum(shard.load() for shard in relay_shards)} connections to finish")
+
+
+# This function handles the messages queued on the main loop's control channel.
+def handle_control_messages():
+    for message in main_control.receive():
+        if message[0] == 'reload':
+            if draining:
+                print("Not reloading the config file while draining.", file=sys.stderr)
+            else:
+                reload_config()
+        elif message[0] == 'drain' and not draining:
+            start_drain()
+
+
+# The signal handlers only queue a message, the main loop does the work. A signal which arrives before
+# the main loop's control channel exists is ignored.
+def request_reload(signum, frame):
+    if main_control is not None:
+        main_control.send(('reload',))
+
+
+def request_drain(signum, frame):
+    if main_control is not None:
+        main_control.send(('drain',))
+
+
+# This function returns the number of seconds the main loop may wait for events before it has timed work
+# to do, or -1 if it has none.
+def main_loop_timeout(next_refill, next_report):
+    deadlines = []
+    if connect_timers:
+        deadlines.append(time.monotonic() + connect_timers.timeout(time.monotonic()))
+    if draining:
+        deadlines.append(drain_deadline)
+    elif any(mapping_options[key]['warm_pool'] for key in port_mapping):
+        deadlines.append(next_refill)
+    if stats_pipe is not None:
+        deadlines.append(next_report)
+    if paused_listeners:
+        deadlines.append(min(paused_listeners.values()))
+    if not deadlines:
+        return -1
+    return max(0, min(deadlines) - time.monotonic())
+
+
+def main():
+    global metrics_server
     # Set up listening sockets
-    port_forward_setup()
+    if takeover:
+        take_over()
+    else:
+        port_forward_setup()
+    if upgrade_socket:
+        open_upgrade_socket()
+    # Worker processes leave the metrics endpoint to the supervisor. During an upgrade the old process
+    # has closed its endpoint by the time the listening sockets have been taken over.
+    if metrics_port and stats_pipe is None:
+        metrics_server = metrics.start_metrics_server(('127.0.0.1', metrics_port), collect_metrics, METRICS)
     # Start threads which will monitor established connections.
-    thread.start()
+    for shard in relay_shards:
+        shard.thread.start()
+    next_report = time.monotonic() + STATS_INTERVAL
+    next_refill = time.monotonic()
     while True:
-        # Poll the listening socket polling object
-        # and accept all the incoming connections.
-        events = multiplexor.poll(1)
-        if len(events) == 0:
-            continue
+        # Poll the listening socket polling object, accept all the incoming connections
+        # and finish any pending connections to the internal host. The loop only wakes up for
+        # events, control messages and timed work.
+        events = multiplexor.poll(main_loop_timeout(next_refill, next_report))
         for fd, event in events:
-            if event == select.EPOLLIN:
-                external_conn, addr = listening_socket_list[fd].accept()
-                print(f"Connection established to {external_conn.getsockname()} from external host {external_conn.getpeername()}")
-                # Once the connection is established between the pf and the external host, create the subsequent
-                # connection between the pf and the internal host using the port map.
-                if external_conn.family == socket.AF_INET:
-                    internal_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    internal_conn.connect((internal_host_ipv4, port_mapping[external_conn.getsockname()[1]]))
-                    print(f"Establishing connection from {external_conn.getsockname()} to internal host {(internal_host_ipv4, port_mapping[external_conn.getsockname()[1]])}")
-                else:
-                    internal_conn = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-                    internal_conn.connect((internal_host_ipv6, port_mapping[external_conn.getsockname()[1]]))
-                    print(f"Establishing connection from {external_conn.getsockname()} to internal host {(internal_host_ipv4, port_mapping[external_conn.getsockname()[1]])}")
-                # Once both connections are made, pass the sockets into the create_two_way_communication function.
-                create_two_way_communication(external_conn, internal_conn)
-                # Once two way communication data structure is established, register the sockets into the
-                # data transfer epoll object.
-                internal_conn.setblocking(0)
-                external_conn.setblocking(0)
-                io.register(internal_conn.fileno(), select.EPOLLIN)
-                io.register(external_conn.fileno(), select.EPOLLIN)
+            if fd in listening_socket_list:
+                accept_connections(fd)
+            elif fd in pending_connections:
+                complete_connection(fd)
+            elif fd == main_control.fd:
+                handle_control_messages()
+            elif upgrade_listener is not None and fd == upgrade_listener.fileno():
+                hand_over()
+        expire_pending_connections()
+        resume_listeners()
+        if draining:
+            if not pending_connections and not any(shard.load() for shard in relay_shards):
+                print("All connections have finished")
+                return
+            if time.monotonic() >= drain_deadline:
+                print(f"Connections still open after {drain_timeout} seconds are closed", file=sys.stderr)
+                return
+        elif time.monotonic() >= next_refill:
+            refill_warm_pools()
+            next_refill = time.monotonic() + WARM_POOL_INTERVAL
+        if stats_pipe is not None and time.monotonic() >= next_report:
+            stats_pipe.send(collect_statistics())
+            next_report = time.monotonic() + STATS_INTERVAL
 
 
-if __name__ == '__main__':
+# This function runs the port forwarder in the current process until it is interrupted.
+def run_forwarder():
+    global running, main_control, connect_timers
+    main_control = ControlChannel()
+    connect_timers = TimerWheel()
+    multiplexor.register(main_control.fd, select.EPOLLIN)
+    for x in range(relay_threads):
+        relay_shards.append(RelayShard())
+    # The health check thread is a daemon so that it can't keep the process alive if start up fails.
+    health_thread = threading.Thread(target=health_check_thread, daemon=True)
+    health_thread.start()
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.signal(signal.SIGTERM, request_drain)
     try:
-        comm_thread = threading.Thread(target=communication_thread)
-        main(comm_thread)
+        main()
     except KeyboardInterrupt:
-        running = False
         print("\nBeginning shutdown please wait...")
-        comm_thread.join()
+    finally:
+        # main only returns once a drain has finished. The relay threads are stopped on any other error too,
+        # otherwise they would keep the process alive.
+        running = False
+        health_wakeup.set()
+        for shard in relay_shards:
+            shard.control.send(('stop',))
+            if shard.thread.is_alive():
+                shard.thread.join()
+        health_thread.join()
         main_thread_shutdown()
-        print("Port Forwarder shutdown successfully")
+    print("Port Forwarder shutdown successfully")
+
+
+# This is the entry point of a worker process. The worker is forked from the supervisor, so it
+# replaces the inherited epoll object with its own before setting up its listening sockets.
+def worker_process(worker_id, pipe):
+    global multiplexor, reuse_port, stats_pipe
+    # The handlers inherited from the supervisor forward the signals to the other workers.
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.signal(signal.SIGTERM, request_drain)
+    multiplexor.close()
+    multiplexor = select.epoll()
+    reuse_port = True
+    stats_pipe = pipe
+    print(f"Worker {worker_id} started with PID {os.getpid()}")
+    run_forwarder()
+    stats_pipe.send(collect_statistics())
+
+
+def start_worker(context, worker_id):
+    parent, child = context.Pipe()
+    process = context.Process(target=worker_process, args=(worker_id, child))
+    process.start()
+    child.close()
+    return process, parent
+
+
+# This function reads every statistics report waiting in the worker pipes.
+def read_worker_statistics(pipes, worker_stats):
+    for worker_id in pipes:
+        try:
+            while pipes[worker_id].poll():
+                worker_stats[worker_id] = pipes[worker_id].recv()
+        except (EOFError, OSError):
+            pass
+
+
+def print_worker_statistics(worker_stats, finished_stats):
+    totals = dict.fromkeys(['total_connections', 'active_connections', 'pending_connections',
+                            'buffer_pool_hits', 'buffer_pool_misses', 'poll_calls'], 0)
+    for data in list(worker_stats.values()) + finished_stats:
+        for key in totals:
+            totals[key] += data[key]
+    print(f"Statistics for {len(worker_stats)} workers:\n"
+          f"\tTotal connections: {totals['total_connections']}\n"
+          f"\tActive connections: {totals['active_connections']}\n"
+          f"\tPending connections: {totals['pending_connections']}\n"
+          f"\tBuffer pool: {totals['buffer_pool_hits']} hits, {totals['buffer_pool_misses']} misses\n"
+          f"\tRelay poll calls: {totals['poll_calls']}")
+
+
+# This function adds up the metrics reported by the workers. Counters of workers which have crashed are
+# kept, but their gauges are not. The health of a backend is averaged over the workers instead.
+def merge_worker_metrics(worker_stats, finished_stats):
+    sample_lists = [data['metrics'] for data in list(worker_stats.values())]
+    for data in finished_stats:
+        sample_lists.append([sample for sample in data['metrics'] if METRICS[sample[0]][0] == 'counter'])
+    samples = metrics.merge_samples(sample_lists)
+    return [(name, labels, value / len(worker_stats) if name == 'port_forwarder_backend_up' else value)
+            for name, labels, value in samples]
+
+
+# This function starts the worker processes, restarts any worker that crashes, and prints the
+# combined statistics of all workers on shutdown. On SIGTERM the workers drain, and the supervisor
+# exits once all of them have exited.
+def supervisor(num_workers):
+    context = multiprocessing.get_context('fork')
+    processes = {}
+    pipes = {}
+    # Latest report from each running worker, and last reports of workers which have crashed.
+    worker_stats = {}
+    finished_stats = []
+    if metrics_port:
+        # The supervisor serves the metrics of all workers, as of their last statistics report.
+        metrics.start_metrics_server(('127.0.0.1', metrics_port),
+                                     lambda: merge_worker_metrics(worker_stats, finished_stats), METRICS)
+    supervisor_pid = os.getpid()
+    # Signals received by the supervisor which have not been handled yet.
+    received_signals = []
+    stopping = False
+
+    # SIGHUP and SIGTERM are forwarded to every worker, which reloads the config file or drains itself.
+    # The supervisor reloads the config file as well, so that a restarted worker starts with the new config.
+    def forward_signal(signum, frame):
+        received_signals.append(signum)
+        # A worker which has just been forked may still run this handler.
+        if os.getpid() != supervisor_pid:
+            return
+        for process in processes.values():
+            try:
+                os.kill(process.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGHUP, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+    for worker_id in range(num_workers):
+        processes[worker_id], pipes[worker_id] = start_worker(context, worker_id)
+    try:
+        while True:
+            wait([process.sentinel for process in processes.values()], timeout=STATS_INTERVAL)
+            read_worker_statistics(pipes, worker_stats)
+            while received_signals:
+                if received_signals.pop(0) == signal.SIGTERM:
+                    stopping = True
+                    continue
+                config = read_config()
+                if config is not None:
+                    apply_config(config)
+            if stopping:
+                # Workers which have drained are not restarted.
+                if not any(process.is_alive() for process in processes.values()):
+                    print("All workers have drained")
+                    break
+                continue
+            for worker_id in processes:
+                if processes[worker_id].is_alive():
+                    continue
+                print(f"Worker {worker_id} exited with code {processes[worker_id].exitcode}, restarting...",
+                      file=sys.stderr)
+                if worker_id in worker_stats:
+                    finished_stats.append(worker_stats.pop(worker_id))
+                pipes[worker_id].close()
+                time.sleep(WORKER_RESTART_DELAY)
+                processes[worker_id], pipes[worker_id] = start_worker(context, worker_id)
+    except KeyboardInterrupt:
+        print("\nStopping workers please wait...")
+        # Workers in the same process group have already received the interrupt, any worker that
+        # is still running after the timeout is interrupted directly.
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        for process in processes.values():
+            process.join(max(0, deadline - time.monotonic()))
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes.values():
+            process.join()
+    read_worker_statistics(pipes, worker_stats)
+    print_worker_statistics(worker_stats, finished_stats)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    # Check that workers is an integer.
+    try:
+        workers = int(args.workers)
+    except ValueError:
+        print(f"Invalid Argument Type: -w flag expects an Integer. Use -h for list of accepted arguments.")
+        sys.exit(0)
+    # Check that relay threads is a positive integer.
+    try:
+        relay_threads = int(args.relay_threads)
+    except ValueError:
+        print(f"Invalid Argument Type: -t flag expects an Integer. Use -h for list of accepted arguments.")
+        sys.exit(0)
+    if relay_threads < 1:
+        print(f"Invalid Argument: -t flag expects at least 1 relay thread. Use -h for list of accepted arguments.")
+        sys.exit(0)
+    # Check that the metrics port is an integer.
+    try:
+        metrics_port = int(args.metrics_port)
+    except ValueError:
+        print(f"Invalid Argument Type: -m flag expects an Integer. Use -h for list of accepted arguments.")
+        sys.exit(0)
+    # Check that the drain timeout is an integer.
+    try:
+        drain_timeout = int(args.drain_timeout)
+    except ValueError:
+        print(f"Invalid Argument Type: -d flag expects an Integer. Use -h for list of accepted arguments.")
+        sys.exit(0)
+    edge_triggered = args.edge_triggered
+    quiet = args.quiet
+    upgrade_socket = args.upgrade_socket
+    takeover = args.takeover
+    takeover_connections = args.takeover_connections
+    if (takeover or takeover_connections) and not upgrade_socket:
+        print(f"Invalid Argument: -T and -C need the upgrade socket given with -u. "
+              f"Use -h for list of accepted arguments.")
+        sys.exit(0)
+    if upgrade_socket and workers > 0:
+        print(f"Invalid Argument: -u can't be used together with -w. Use -h for list of accepted arguments.")
+        sys.exit(0)
+    if workers > 0:
+        supervisor(workers)
+    else:
+        run_forwarder()
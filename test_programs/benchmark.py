@@ -0,0 +1,620 @@
+import argparse
+import array
+import errno
+import math
+import multiprocessing
+import os
+import resource
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import results_store
+
+# Loopback benchmark suite. Starts each forwarder engine in front of an echo backend and a sink backend on
+# 127.0.0.1, runs every test over a matrix of connection counts and payload sizes, prints one line per
+# result and appends every result as a record to the results store, see results_store.py.
+#
+# Tests:
+#   throughput: every connection keeps sending payload sized writes to the sink backend. The bytes counted
+#               by the sink over the measured window give the throughput in GB/s.
+#   latency:    every connection sends a payload to the echo backend and waits for it to come back before
+#               sending the next one. Gives requests per second and round trip time percentiles.
+#   connect:    every connection slot opens a connection, sends a payload, waits for the echo and closes
+#               the connection before opening the next one. Gives connections per second.
+#   half_close: every connection slot opens a connection, sends a payload to the echo backend, shuts down
+#               its sending side and reads the echo slowly through a small receive buffer until the end of
+#               the connection, before opening the next one. Gives connections per second, a connection
+#               which ends before the whole echo came back counts as an error. The forwarder only still holds
+#               part of the echo when the backend closes if the payload is larger than its buffers, for
+#               example -s 4194304.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Engines which can be benchmarked where:
+#   key = engine name, value = (script in the repository, extra arguments, port mapping options).
+# The direct engine has no forwarder, the clients connect straight to the backends. It shows how much
+# the clients and backends of the benchmark can do on their own.
+ENGINES = {
+    'direct': None,
+    'epoll': ('port_forwarder.py', ['-q'], ''),
+    'edge': ('port_forwarder.py', ['-q', '-e'], ''),
+    'splice': ('port_forwarder.py', ['-q'], 'engine=splice'),
+    'splice-et': ('port_forwarder.py', ['-q', '-e'], 'engine=splice'),
+    'asyncio': ('async_forwarder.py', [], ''),
+}
+TESTS = ('throughput', 'latency', 'connect', 'half_close')
+
+# Settings of a test which are stored as its parameters, everything else it returns is a result.
+PARAMETERS = ('connections', 'payload', 'duration')
+
+# Seconds to wait for a forwarder to start listening or to shut down.
+START_TIMEOUT = 10
+STOP_TIMEOUT = 10
+
+# Seconds between starting the client processes and starting the test, so that every process has
+# opened its connections.
+START_DELAY = 1
+
+# Number of bytes read from a socket at once by the backends and the clients.
+RECV_SIZE = 1048576
+
+# Receive buffer of the half_close connections, and the bytes read from each of them and the seconds slept
+# between those reads, so that the echo piles up in the forwarder after the backend has closed.
+HALF_CLOSE_RCVBUF = 4096
+HALF_CLOSE_READ_SIZE = 4096
+HALF_CLOSE_READ_DELAY = 0.001
+
+
+# This function parses a comma separated list of integers, and exits if it is not one.
+def parse_integers(text, flag):
+    try:
+        values = [int(value) for value in text.split(',')]
+    except ValueError:
+        print(f"Invalid Argument Type: {flag} flag expects comma separated Integers. "
+              f"Use -h for list of accepted arguments.")
+        sys.exit(0)
+    if any(value < 1 for value in values):
+        print(f"Invalid Argument Type: {flag} flag expects Integers of at least 1. "
+              f"Use -h for list of accepted arguments.")
+        sys.exit(0)
+    return values
+
+
+# This function parses a comma separated list of names, and exits if one of them is not allowed.
+def parse_names(text, flag, allowed):
+    names = text.split(',')
+    for name in names:
+        if name not in allowed:
+            print(f"Invalid Argument Type: {flag} flag accepts {', '.join(allowed)}. "
+                  f"Use -h for list of accepted arguments.")
+            sys.exit(0)
+    return names
+
+
+# This function returns a free TCP port on the loopback interface.
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# This function opens listening sockets on the IPv4 and, if available, the IPv6 loopback address.
+def open_listeners(port):
+    listeners = []
+    for family, host in ((socket.AF_INET, '127.0.0.1'), (socket.AF_INET6, '::1')):
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+            sock.listen(4096)
+        except OSError:
+            if family == socket.AF_INET:
+                raise
+            continue
+        sock.setblocking(False)
+        listeners.append(sock)
+    return listeners
+
+
+# This function runs the backends in their own process. Connections to the sink port are read and
+# their bytes are added to counter, connections to the echo port get back whatever they send.
+def backend_server(listeners, sink_port, counter):
+    selector = selectors.DefaultSelector()
+    for sock in listeners:
+        selector.register(sock, selectors.EVENT_READ, 'listen')
+    buffer = bytearray(RECV_SIZE)
+    # Holds the echo a connection has not taken yet where: key = socket, value = bytes.
+    unsent = {}
+
+    def close(sock):
+        selector.unregister(sock)
+        unsent.pop(sock, None)
+        sock.close()
+
+    while True:
+        for key, events in selector.select():
+            sock = key.fileobj
+            if key.data == 'listen':
+                try:
+                    conn, addr = sock.accept()
+                except OSError:
+                    continue
+                conn.setblocking(False)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                selector.register(conn, selectors.EVENT_READ, 'sink' if sock.getsockname()[1] == sink_port else 'echo')
+                continue
+            if events & selectors.EVENT_WRITE:
+                try:
+                    sent = sock.send(unsent[sock])
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    close(sock)
+                    continue
+                unsent[sock] = unsent[sock][sent:]
+                if not unsent[sock]:
+                    del unsent[sock]
+                    selector.modify(sock, selectors.EVENT_READ, key.data)
+                continue
+            try:
+                received = sock.recv_into(buffer)
+            except BlockingIOError:
+                continue
+            except OSError:
+                received = 0
+            if received and key.data == 'sink':
+                counter.value += received
+                continue
+            if received:
+                try:
+                    sent = sock.send(memoryview(buffer)[:received])
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    close(sock)
+                    continue
+                if sent < received:
+                    # The client reads slower than it sends, nothing more is read until the rest is sent.
+                    unsent[sock] = bytes(buffer[sent:received])
+                    selector.modify(sock, selectors.EVENT_WRITE, key.data)
+                continue
+            close(sock)
+
+
+# This function writes the config file of a forwarder which maps one port to the echo backend and one
+# to the sink backend.
+def write_config(directory, mappings, options):
+    with open(os.path.join(directory, 'config'), 'w', encoding='utf-8') as config:
+        config.write("server_host_ipv4 127.0.0.1\ninternal_host_ipv4 127.0.0.1\n"
+                     "server_host_ipv6 ::1\ninternal_host_ipv6 ::1\n")
+        for external_port, internal_port in mappings:
+            config.write(f"{external_port} {internal_port} {options}\n")
+
+
+# This function waits until something accepts connections on the port. Returns False if nothing does
+# within START_TIMEOUT seconds.
+def wait_for_port(port, process):
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+# This function starts the forwarder of the engine in a temporary directory. Returns the process, or None
+# if the forwarder did not start.
+def start_forwarder(engine, directory, mappings, forwarder_args):
+    script, extra_args, options = ENGINES[engine]
+    write_config(directory, mappings, options)
+    command = [sys.executable, os.path.join(REPO_DIR, script)] + extra_args
+    if script == 'port_forwarder.py':
+        command += forwarder_args
+    # SIGINT is used to stop the forwarder, so it must not be inherited as ignored.
+    process = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL,
+                               preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+    if not wait_for_port(mappings[0][0], process):
+        stop_forwarder(process)
+        return None
+    return process
+
+
+def stop_forwarder(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# This function opens the connections of a throughput or latency test. Connections which cannot be
+# opened are counted as errors.
+def open_connections(address, count):
+    connections = []
+    errors = 0
+    for x in range(count):
+        try:
+            sock = socket.create_connection(address, timeout=START_TIMEOUT)
+        except OSError:
+            errors += 1
+            continue
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connections.append(sock)
+    return connections, errors
+
+
+# This function runs the client side of a test with count connections in one process, and returns its
+# counts. Everything which finishes between warmup_end and end is counted, latencies are in microseconds.
+def run_client(test, address, count, payload, start, warmup_end, end):
+    selector = selectors.DefaultSelector()
+    message = memoryview(b'x' * payload)
+    buffer = bytearray(RECV_SIZE)
+    latencies = array.array('d')
+    completed = 0
+    errors = 0
+    # Holds the state of each connection where:
+    #   key = socket, value = [unsent part of the message, bytes received, time the request was started].
+    state = {}
+
+    def begin_request(sock, now):
+        state[sock] = [message, 0, now]
+        send_request(sock)
+
+    def send_request(sock):
+        try:
+            sent = sock.send(state[sock][0])
+        except BlockingIOError:
+            sent = 0
+        state[sock][0] = state[sock][0][sent:]
+        if state[sock][0]:
+            selector.modify(sock, selectors.EVENT_WRITE)
+        else:
+            selector.modify(sock, selectors.EVENT_READ)
+
+    def open_connection(now):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        result = sock.connect_ex(address)
+        if result not in (0, errno.EINPROGRESS):
+            sock.close()
+            return False
+        state[sock] = [None, 0, now]
+        selector.register(sock, selectors.EVENT_WRITE)
+        return True
+
+    def close_connection(sock):
+        selector.unregister(sock)
+        del state[sock]
+        sock.close()
+
+    if test == 'connect':
+        connections = []
+    else:
+        connections, errors = open_connections(address, count)
+    time.sleep(max(0, start - time.monotonic()))
+    now = time.monotonic()
+    if test == 'connect':
+        for x in range(count):
+            errors += not open_connection(now)
+    elif test == 'throughput':
+        for sock in connections:
+            selector.register(sock, selectors.EVENT_WRITE)
+    else:
+        for sock in connections:
+            selector.register(sock, selectors.EVENT_WRITE)
+            begin_request(sock, now)
+
+    while now < end:
+        for key, events in selector.select(end - now):
+            sock = key.fileobj
+            if sock not in state and test != 'throughput':
+                continue
+            try:
+                if test == 'throughput':
+                    sock.send(message)
+                    continue
+                if state[sock][0] is None:
+                    # A non-blocking connect has finished.
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        raise ConnectionRefusedError
+                    begin_request(sock, state[sock][2])
+                elif events & selectors.EVENT_WRITE:
+                    send_request(sock)
+                else:
+                    received = sock.recv_into(buffer)
+                    if received == 0:
+                        raise ConnectionResetError
+                    state[sock][1] += received
+            except BlockingIOError:
+                continue
+            except OSError:
+                errors += 1
+                if test == 'throughput':
+                    selector.unregister(sock)
+                    sock.close()
+                    continue
+                close_connection(sock)
+                if test == 'connect':
+                    errors += not open_connection(time.monotonic())
+                continue
+            if test == 'throughput' or state[sock][1] < payload:
+                continue
+            # The whole payload has come back.
+            now = time.monotonic()
+            if warmup_end <= now < end:
+                completed += 1
+                latencies.append((now - state[sock][2]) * 1000000)
+            if test == 'connect':
+                close_connection(sock)
+                errors += not open_connection(now)
+            else:
+                begin_request(sock, now)
+        now = time.monotonic()
+
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    for sock in connections:
+        sock.close()
+    selector.close()
+    return completed, errors, latencies.tobytes()
+
+
+# This function runs the client side of the half_close test with count connection slots in one process, and
+# returns its counts like run_client. The echo is read while the message is still being sent, so the payload
+# can be larger than every buffer on the way.
+def run_half_close_client(address, count, payload, start, warmup_end, end):
+    selector = selectors.DefaultSelector()
+    message = memoryview(b'x' * payload)
+    latencies = array.array('d')
+    completed = 0
+    errors = 0
+    # Holds the state of each connection where:
+    #   key = socket, value = [unsent part of the message, bytes received, time the connection was opened].
+    state = {}
+
+    def open_connection(now):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # The receive buffer is set before connecting, so the window advertised to the forwarder stays small.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, HALF_CLOSE_RCVBUF)
+        sock.setblocking(False)
+        result = sock.connect_ex(address)
+        if result not in (0, errno.EINPROGRESS):
+            sock.close()
+            return False
+        state[sock] = [None, 0, now]
+        selector.register(sock, selectors.EVENT_WRITE)
+        return True
+
+    def close_connection(sock):
+        selector.unregister(sock)
+        del state[sock]
+        sock.close()
+
+    time.sleep(max(0, start - time.monotonic()))
+    now = time.monotonic()
+    for x in range(count):
+        errors += not open_connection(now)
+
+    while now < end:
+        for key, events in selector.select(end - now):
+            sock = key.fileobj
+            try:
+                if state[sock][0] is None:
+                    # A non-blocking connect has finished.
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        raise ConnectionRefusedError
+                    state[sock][0] = message
+                    selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                if events & selectors.EVENT_WRITE and state[sock][0]:
+                    sent = sock.send(state[sock][0])
+                    state[sock][0] = state[sock][0][sent:]
+                    if not state[sock][0]:
+                        sock.shutdown(socket.SHUT_WR)
+                        selector.modify(sock, selectors.EVENT_READ)
+                if not events & selectors.EVENT_READ:
+                    continue
+                received = len(sock.recv(HALF_CLOSE_READ_SIZE))
+            except BlockingIOError:
+                continue
+            except OSError:
+                received = 0
+            if received:
+                state[sock][1] += received
+                continue
+            # The connection has ended, it passes if the whole payload came back after the half close.
+            now = time.monotonic()
+            if state[sock][0] or state[sock][1] != payload:
+                errors += 1
+            elif warmup_end <= now < end:
+                completed += 1
+                latencies.append((now - state[sock][2]) * 1000000)
+            close_connection(sock)
+            errors += not open_connection(now)
+        time.sleep(HALF_CLOSE_READ_DELAY)
+        now = time.monotonic()
+
+    for sock in list(state):
+        sock.close()
+    selector.close()
+    return completed, errors, latencies.tobytes()
+
+
+# This function returns the value below which the given fraction of the sorted values fall.
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+# This function runs one test against the address with the connections spread over the client
+# processes, and returns the result.
+def run_test(pool, test, address, connections, payload, processes, warmup, duration, counter):
+    start = time.monotonic() + START_DELAY
+    warmup_end = start + warmup
+    end = warmup_end + duration
+    processes = min(processes, connections)
+    jobs = []
+    for x in range(processes):
+        count = connections // processes + (1 if x < connections % processes else 0)
+        if test == 'half_close':
+            jobs.append(pool.apply_async(run_half_close_client, (address, count, payload, start, warmup_end, end)))
+        else:
+            jobs.append(pool.apply_async(run_client, (test, address, count, payload, start, warmup_end, end)))
+    if test == 'throughput':
+        time.sleep(max(0, warmup_end - time.monotonic()))
+        first = counter.value
+        time.sleep(max(0, end - time.monotonic()))
+        received = counter.value - first
+    completed = 0
+    errors = 0
+    latencies = array.array('d')
+    for job in jobs:
+        job_completed, job_errors, job_latencies = job.get()
+        completed += job_completed
+        errors += job_errors
+        latencies.frombytes(job_latencies)
+    result = {'test': test, 'connections': connections, 'payload': payload, 'duration': duration, 'errors': errors}
+    if test == 'throughput':
+        result['bytes'] = received
+        result['gigabytes_per_second'] = received / duration / 1e9
+        return result
+    values = sorted(latencies)
+    result['completed'] = completed
+    result['per_second'] = completed / duration
+    for name, fraction in (('p50_us', 0.5), ('p90_us', 0.9), ('p99_us', 0.99), ('p999_us', 0.999)):
+        result[name] = percentile(values, fraction)
+    result['max_us'] = values[-1] if values else 0
+    return result
+
+
+def print_result(engine, result):
+    line = f"{engine:9} {result['test']:10} connections={result['connections']:<6} payload={result['payload']:<8}"
+    if result['test'] == 'throughput':
+        line += f" {result['gigabytes_per_second']:.3f} GB/s"
+    elif result['test'] == 'latency':
+        line += (f" {result['per_second']:.0f} requests/s p50 {result['p50_us']:.0f}us p99 {result['p99_us']:.0f}us "
+                 f"p99.9 {result['p999_us']:.0f}us")
+    else:
+        line += f" {result['per_second']:.0f} connections/s p50 {result['p50_us']:.0f}us p99 {result['p99_us']:.0f}us"
+    print(f"{line} errors={result['errors']}", flush=True)
+
+
+# This function turns a result returned by run_test into a record of the results store.
+def make_record(run, engine, result):
+    parameters = {name: result[name] for name in PARAMETERS}
+    results = {name: value for name, value in result.items() if name not in PARAMETERS and name != 'test'}
+    return results_store.make_record(run, engine, result['test'], parameters, results)
+
+
+def main():
+    # Command Line Argument Parsing
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--engines", dest="engines", default=','.join(ENGINES),
+                        help=f"Comma separated engines to benchmark, from {', '.join(ENGINES)}. "
+                             f"Default is all of them.", required=False)
+    parser.add_argument("-t", "--tests", dest="tests", default=','.join(TESTS),
+                        help=f"Comma separated tests to run, from {', '.join(TESTS)}. Default is all of them.",
+                        required=False)
+    parser.add_argument("-c", "--connections", dest="connections", default="1,10,100",
+                        help="Comma separated numbers of concurrent connections. Default is 1,10,100.", required=False)
+    parser.add_argument("-s", "--sizes", dest="sizes", default="64,1024,65536",
+                        help="Comma separated payload sizes in bytes. Default is 64,1024,65536.", required=False)
+    parser.add_argument("-d", "--duration", dest="duration", default=5,
+                        help="Seconds measured for each test. Default value is 5.", required=False)
+    parser.add_argument("-W", "--warmup", dest="warmup", default=1,
+                        help="Seconds each test runs before it is measured. Default value is 1.", required=False)
+    parser.add_argument("-P", "--processes", dest="processes", default=1,
+                        help="Number of client processes the connections are spread over. Default value is 1.",
+                        required=False)
+    parser.add_argument("-a", "--forwarder-args", dest="forwarder_args", default="",
+                        help="Extra arguments passed to port_forwarder.py, for example \"-t 4\".", required=False)
+    parser.add_argument("-o", "--output", dest="output", default=results_store.DEFAULT_STORE,
+                        help=f"Results store the results are appended to. Default is {results_store.DEFAULT_STORE}.",
+                        required=False)
+    args = parser.parse_args()
+
+    engines = parse_names(args.engines, '-e', list(ENGINES))
+    tests = parse_names(args.tests, '-t', TESTS)
+    connection_counts = parse_integers(args.connections, '-c')
+    sizes = parse_integers(args.sizes, '-s')
+    try:
+        duration = float(args.duration)
+        warmup = float(args.warmup)
+        processes = int(args.processes)
+    except ValueError:
+        print(f"Invalid Argument Type: -d and -W flags expect numbers, -P expects an Integer. "
+              f"Use -h for list of accepted arguments.")
+        sys.exit(0)
+    if duration <= 0 or warmup < 0 or processes < 1:
+        print(f"Invalid Argument Type: -d must be positive, -W can't be negative and -P must be at least 1. "
+              f"Use -h for list of accepted arguments.")
+        sys.exit(0)
+
+    # Every connection uses up to three file descriptors on this machine, one in the client, the
+    # forwarder and the backend each.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    context = multiprocessing.get_context('fork')
+    echo_port = free_port()
+    sink_port = free_port()
+    counter = context.RawValue('Q', 0)
+    listeners = open_listeners(echo_port) + open_listeners(sink_port)
+    backend = context.Process(target=backend_server, args=(listeners, sink_port, counter), daemon=True)
+    backend.start()
+    for sock in listeners:
+        sock.close()
+    pool = context.Pool(processes)
+
+    run = results_store.describe_run('benchmark', vars(args))
+    results = []
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        for engine in engines:
+            forwarder = None
+            if ENGINES[engine] is None:
+                ports = {'sink': sink_port, 'echo': echo_port}
+            else:
+                ports = {'echo': free_port(), 'sink': free_port()}
+                mappings = [(ports['echo'], echo_port), (ports['sink'], sink_port)]
+                forwarder = start_forwarder(engine, directory, mappings, args.forwarder_args.split())
+                if forwarder is None:
+                    print(f"{engine:9} did not start, skipping it", flush=True)
+                    continue
+            try:
+                for test in tests:
+                    address = ('127.0.0.1', ports['sink' if test == 'throughput' else 'echo'])
+                    for connections in connection_counts:
+                        for payload in sizes:
+                            result = run_test(pool, test, address, connections, payload, processes, warmup,
+                                              duration, counter)
+                            print_result(engine, result)
+                            # Every result is stored right away, so an interrupted run keeps what it measured.
+                            results_store.append_records(args.output, [make_record(run, engine, result)])
+                            results.append(result)
+            finally:
+                if forwarder is not None:
+                    stop_forwarder(forwarder)
+    except KeyboardInterrupt:
+        print("\nBenchmark interrupted")
+    finally:
+        pool.terminate()
+        backend.terminate()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    print(f"{len(results)} results of run {run['id']} written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,67 @@
 #!/usr/bin/python3.9
 import argparse
+import array
+import asyncio
+import collections
+import multiprocessing
+import resource
 import socket
 import ssl
-from os.path import exists
 import time
-import threading
-from threading import Lock
 import sys
+from os.path import exists
+import results_store
+
+# Load generator for the echo servers, directly or through the port forwarder. Every client connection is
+# an asyncio protocol, so a single process can hold tens of thousands of connections, and -P spreads them
+# over several processes. The server is expected to send back every byte it receives.
+#
+# Modes:
+#   closed: every client keeps -D requests in flight, and sends the next one as soon as a response has come
+#           back, until it has received -b bytes back or -d seconds have passed.
+#   open:   requests are sent at a fixed total rate of -r per second, round robin over the clients, whether
+#           or not the earlier ones have been answered. A response time is measured from when its request
+#           was due, so a server which falls behind shows up in the response times instead of slowing
+#           down the clients.
 
 # Command Line Argument Parsing
 parser = argparse.ArgumentParser()
 parser.add_argument("-s", "--server", dest="server", help="Server IP address", required=True)
 parser.add_argument("-p", "--port", dest="port", help="Server port number", required=True)
-parser.add_argument("-b", "--bytes", dest="bytes", help="Number of bytes to send to the server.", required=True)
-parser.add_argument("-c", "--clients", dest="clients", help="Number of client threads to create.", required=True)
+parser.add_argument("-b", "--bytes", dest="bytes", default=0,
+                    help="Number of bytes each client sends to the server in closed mode. Default value is 0, "
+                         "meaning send for -d seconds.", required=False)
+parser.add_argument("-c", "--clients", dest="clients", help="Number of client connections to create.", required=True)
 parser.add_argument("-l", "--log", dest="log", default=0,
-                    help="Acceptable values: 0 or 1. If 1 then the statistics will be logged to a file. Default value is 0 meaning do not log.",
+                    help="Acceptable values: 0 or 1. If 1 then the statistics will be logged to a file and appended to the results store. Default value is 0 meaning do not log.",
+                    required=False)
+parser.add_argument("-o", "--output", dest="output", default=results_store.DEFAULT_STORE,
+                    help=f"Results store the statistics are appended to when -l is 1. "
+                         f"Default is {results_store.DEFAULT_STORE}.", required=False)
+parser.add_argument("-n", "--name", dest="name", default="server",
+                    help="Name the server or forwarder under test is stored with in the results store. "
+                         "Default is server.", required=False)
+parser.add_argument("-m", "--mode", dest="mode", default="closed",
+                    help="Acceptable values: closed or open. Default value is closed.", required=False)
+parser.add_argument("-r", "--rate", dest="rate", default=1000,
+                    help="Total number of requests per second sent in open mode. Default value is 1000.", required=False)
+parser.add_argument("-z", "--size", dest="size", default=1024,
+                    help="Number of bytes in each request. Default value is 1024.", required=False)
+parser.add_argument("-D", "--depth", dest="depth", default=1,
+                    help="Number of requests each client keeps in flight in closed mode. Default value is 1.",
                     required=False)
+parser.add_argument("-d", "--duration", dest="duration", default=10,
+                    help="Number of seconds requests are sent for. In closed mode this only applies when -b is 0. "
+                         "Default value is 10.", required=False)
+parser.add_argument("-P", "--processes", dest="processes", default=1,
+                    help="Number of processes the clients are spread over. Default value is 1.", required=False)
+parser.add_argument("-S", "--source", dest="source", default=None,
+                    help="Comma separated local IP addresses the clients connect from, round robin. Each address "
+                         "has its own range of ports, so more than one is needed for very many clients.",
+                    required=False)
+parser.add_argument("-T", "--tls", dest="tls", default=1,
+                    help="Acceptable values: 0 or 1. If 1 then the connections use TLS, as expected by server.py. "
+                         "Default value is 1.", required=False)
 args = parser.parse_args()
 
 # Check ip and port are supplied.
@@ -63,17 +108,6 @@ if LOG != 0:
         sys.exit(0)
 
 server = (ip, port)
-BUFF_SIZE = 1024
-avg_response_time_list = set()
-avg_response_time_of_clients = 0
-avg_connection_time = 0
-connection_time_list = set()
-request_list = set()
-avg_requests = 0
-avg_bytes_sent = 0
-total_bytes_sent = 0
-bytes_sent_list = []
-lock = Lock()
 try:
     num_bytes = int(args.bytes)
 except ValueError:
@@ -84,6 +118,101 @@ try:
 except ValueError:
     print(f"Invalid Argument Type: -c expects an Integer. Use -h for list of accepted arguments.")
     sys.exit(0)
+if args.mode not in ('closed', 'open'):
+    print(f"Invalid Argument Type: -m flag expects closed or open. Use -h for list of accepted arguments.")
+    sys.exit(0)
+mode = args.mode
+try:
+    rate = float(args.rate)
+    duration = float(args.duration)
+except ValueError:
+    print(f"Invalid Argument Type: -r and -d flags expect numbers. Use -h for list of accepted arguments.")
+    sys.exit(0)
+try:
+    message_size = int(args.size)
+    depth = int(args.depth)
+    num_processes = int(args.processes)
+    TLS = int(args.tls)
+except ValueError:
+    print(f"Invalid Argument Type: -z, -D, -P and -T flags expect Integers. Use -h for list of accepted arguments.")
+    sys.exit(0)
+if num_clients < 1 or num_bytes < 0 or rate <= 0 or duration <= 0 or message_size < 1 or depth < 1 \
+        or num_processes < 1 or TLS not in (0, 1):
+    print(f"Invalid Argument Type: -c, -z, -D and -P must be at least 1, -r and -d must be positive, -b can't be "
+          f"negative and -T must be 1 or 0. Use -h for list of accepted arguments.")
+    sys.exit(0)
+num_processes = min(num_processes, num_clients)
+source_addresses = args.source.split(',') if args.source else []
+for address in source_addresses:
+    try:
+        socket.inet_aton(address)
+    except socket.error:
+        print(f"Invalid Argument Type: -S flag expects IP addresses. Use -h for list of accepted arguments.")
+        sys.exit(0)
+
+# Number of connections which are being opened at the same time, so that the listen backlog of the
+# server does not overflow.
+CONNECT_CONCURRENCY = 1000
+
+# Number of seconds to wait for the responses to the requests which are in flight when sending stops.
+DRAIN_TIMEOUT = 5
+
+# Every client uses one file descriptor.
+soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+
+# Response times are recorded in a log-bucketed histogram like an HDR histogram. Values below
+# 2 * HISTOGRAM_SUB_BUCKETS microseconds have a bucket each, larger values share a bucket with the values
+# that only differ below their HISTOGRAM_SUB_BUCKET_BITS + 1 most significant bits, which keeps every
+# bucket within 1% of its values. The counts of all response times up to HISTOGRAM_MAX_SHIFT doublings
+# fit into one preallocated array, and histograms of several processes are merged by adding the counts.
+HISTOGRAM_SUB_BUCKET_BITS = 7
+HISTOGRAM_SUB_BUCKETS = 1 << HISTOGRAM_SUB_BUCKET_BITS
+HISTOGRAM_MAX_SHIFT = 30
+
+
+class LatencyHistogram:
+
+    def __init__(self):
+        self.counts = array.array('Q', bytes(8 * HISTOGRAM_SUB_BUCKETS * (HISTOGRAM_MAX_SHIFT + 2)))
+        self.total = 0
+        self.max = 0
+
+    # This method counts a response time given in seconds.
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value > self.max:
+            self.max = value
+        shift = min(max(value.bit_length() - HISTOGRAM_SUB_BUCKET_BITS - 1, 0), HISTOGRAM_MAX_SHIFT)
+        index = min(HISTOGRAM_SUB_BUCKETS * shift + (value >> shift), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.total += 1
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # This method returns the highest value in microseconds of the bucket of the given index.
+    def bucket_value(self, index):
+        shift = max(index // HISTOGRAM_SUB_BUCKETS - 1, 0)
+        return ((index - HISTOGRAM_SUB_BUCKETS * shift + 1) << shift) - 1
+
+    # This method returns the response time in microseconds which the given fraction of responses did not
+    # exceed, or 0 if nothing has been recorded.
+    def percentile(self, fraction):
+        if self.total == 0:
+            return 0
+        rank = max(1, int(fraction * self.total + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_value(index), self.max)
+        return self.max
 
 
 def calc_avg(list):
@@ -97,103 +226,285 @@ def calc_avg(list):
     return avg
 
 
-def client_func(bytes_to_send, sock):
-    conn_time_start = time.time()
-    bytes_received = 0
-    bytes_sent = 0
-    response_times = set()
-    num_requests = 0
-    while bytes_received < bytes_to_send:
-        data = b'a' * BUFF_SIZE
-        send_time = time.time()
-        bytes_sent += sock.send(data)
-        num_requests = num_requests + 1
-        try:
-            response = sock.recv(BUFF_SIZE)
-            recv_time = time.time()
-            response_times.add(recv_time - send_time)
-        except ConnectionResetError:
-            print("Socket disconnected")
-            sock.close()
-            break
-        except TimeoutError:
-            print("Socket disconnected")
-            sock.close()
-            break
-        bytes_received += len(response)
-    conn_time_end = time.time()
-    avg_response_time = calc_avg(response_times)
-    # Send the client specific statistics to the main thread,
-    # so that it can compile the results.
-    lock.acquire()
-    request_list.add(num_requests)
-    connection_time_list.add(conn_time_end - conn_time_start)
-    if avg_response_time != -1:
-        avg_response_time_list.add(avg_response_time)
-    bytes_sent_list.append(bytes_sent)
-    lock.release()
-
-
-sock_list = []
-thread_list = []
-unable_to_connect = 0
-
-# Creating SSL Context.
-context = ssl.SSLContext()
-context.load_cert_chain(certfile="./cacert.pem", keyfile="./cakey.pem", password="password")
-context.load_verify_locations(capath='./cacert.pem')
-
-connection_time_start = time.time()
-print("Creating client sockets and connecting to server...")
-for x in range(0, num_clients):
-    try:
-        sock = socket.create_connection(server, timeout=60)
-        sock = context.wrap_socket(sock=sock, do_handshake_on_connect=False, server_side=False)
-    except OSError:
-        unable_to_connect = unable_to_connect + 1
-        continue
-    sock.settimeout(120)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock_list.append(sock)
-print("Creating thread pool...")
-for sock in sock_list:
-    thread_list.append(threading.Thread(target=client_func, args=(num_bytes, sock)))
-print(f"{len(thread_list)} threads created.")
-for sock in sock_list:
-    sock.do_handshake()
-connection_time_end = time.time()
-connection_time = connection_time_end - connection_time_start
-input(f"To begin sending data, press the enter key.")
-print("Starting threads...")
-transmission_time_start = time.time()
-for thread in thread_list:
-    thread.start()
-for thread in thread_list:
-    thread.join()
-transmission_time_end = time.time()
-transmission_time = transmission_time_end - transmission_time_start
-
-for sock in sock_list:
-    sock.close()
-
-# Main thread calculates the average of the average response times of each client.
-avg_response_time_of_clients = calc_avg(avg_response_time_list)
-avg_bytes_sent = calc_avg(bytes_sent_list)
-total_bytes_sent = sum(bytes_sent_list)
-avg_connection_time = calc_avg(connection_time_list)
-avg_requests = calc_avg(request_list)
-
-print(f"{len(thread_list)} threads finished\n"
-      f"{len(sock_list)} sockets closed.")
+# Protocol of one client connection. Responses are matched to requests by counting bytes, the echo of a
+# request can arrive in several pieces and one read can hold the echoes of several requests.
+class ClientProtocol(asyncio.Protocol):
+
+    def __init__(self, load):
+        self.load = load
+        self.transport = None
+        # Times at which the requests which have not been answered yet were due.
+        self.due_times = collections.deque()
+        # Bytes received of the response which has not fully arrived yet.
+        self.partial = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.finished = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send_request(self, due_time):
+        self.transport.write(self.load.message)
+        self.due_times.append(due_time)
+        self.bytes_sent += message_size
+        self.load.requests += 1
+        self.load.in_flight += 1
+
+    def data_received(self, data):
+        now = time.monotonic()
+        self.bytes_received += len(data)
+        self.partial += len(data)
+        while self.partial >= message_size and self.due_times:
+            self.partial -= message_size
+            self.load.response_received(self, now - self.due_times.popleft(), now)
+
+    def connection_lost(self, exc):
+        self.load.connection_lost(self)
+
+
+# Holds the clients of one process, drives their requests and collects their statistics.
+class LoadGenerator:
+
+    def __init__(self):
+        self.message = b'a' * message_size
+        self.clients = []
+        self.requests = 0
+        self.responses = 0
+        # Number of requests which have been sent but not answered.
+        self.in_flight = 0
+        self.response_time_sum = 0
+        self.histogram = LatencyHistogram()
+        # Number of responses received in each second since sending started.
+        self.responses_per_second = array.array('Q')
+        self.unable_to_connect = 0
+        self.disconnected = 0
+        self.transmission_times = []
+        self.start_time = 0
+        self.last_response = 0
+        self.sending = False
+        # Number of clients which still have requests to send or answers to wait for in closed mode.
+        self.active = 0
+        # Set once there is nothing left to wait for.
+        self.all_done = None
+
+    # This method opens one client connection, returns the protocol or None if it could not connect.
+    async def connect(self, index, limit, context):
+        loop = asyncio.get_running_loop()
+        local_address = (source_addresses[index % len(source_addresses)], 0) if source_addresses else None
+        async with limit:
+            try:
+                transport, protocol = await loop.create_connection(lambda: ClientProtocol(self), ip, port,
+                                                                   ssl=context, local_addr=local_address)
+            except OSError:
+                self.unable_to_connect += 1
+                return None
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return protocol
+
+    def response_received(self, protocol, response_time, now):
+        self.responses += 1
+        self.in_flight -= 1
+        self.response_time_sum += response_time
+        self.histogram.record(response_time)
+        second = int(now - self.start_time)
+        while len(self.responses_per_second) <= second:
+            self.responses_per_second.append(0)
+        self.responses_per_second[second] += 1
+        self.last_response = now
+        if mode == 'open':
+            if not self.sending and self.in_flight == 0:
+                self.all_done.set()
+        elif self.sending and (num_bytes == 0 or protocol.bytes_sent < num_bytes):
+            protocol.send_request(now)
+        elif not protocol.due_times:
+            self.finish(protocol, now)
+
+    # This method is called in closed mode when a client has received everything it is waiting for, or
+    # has lost its connection.
+    def finish(self, protocol, now, completed=True):
+        protocol.finished = True
+        if completed:
+            self.transmission_times.append(now - self.start_time)
+        self.active -= 1
+        if self.active == 0:
+            self.all_done.set()
+
+    def connection_lost(self, protocol):
+        # Connections are closed once the test is over, which is not a failure.
+        if protocol.finished or self.all_done.is_set() or protocol not in self.clients:
+            return
+        self.disconnected += 1
+        self.in_flight -= len(protocol.due_times)
+        protocol.due_times.clear()
+        self.clients.remove(protocol)
+        if mode == 'closed':
+            self.finish(protocol, time.monotonic(), completed=False)
+        elif not self.sending and self.in_flight == 0:
+            self.all_done.set()
+
+    # This coroutine sends requests at the given rate round robin over the clients until the end time.
+    async def send_open_loop(self, rate, end):
+        sent = 0
+        index = 0
+        while self.clients:
+            now = time.monotonic()
+            if now >= end:
+                break
+            due = int((now - self.start_time) * rate) + 1
+            while sent < due:
+                client = self.clients[index % len(self.clients)]
+                client.send_request(self.start_time + sent / rate)
+                index += 1
+                sent += 1
+            await asyncio.sleep(max(0, self.start_time + sent / rate - time.monotonic()))
+
+    # This coroutine stops sending once the end time has come, unless every client finished earlier.
+    async def stop_at(self, end):
+        await asyncio.sleep(max(0, end - time.monotonic()))
+        self.sending = False
+        for client in list(self.clients):
+            if not client.finished and not client.due_times:
+                self.finish(client, time.monotonic())
+
+    async def run(self, first_client, count, rate, barrier):
+        loop = asyncio.get_running_loop()
+        self.all_done = asyncio.Event()
+        context = None
+        if TLS:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            context.load_cert_chain(certfile="./cacert.pem", keyfile="./cakey.pem", password="password")
+        limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+        connection_time_start = time.monotonic()
+        protocols = await asyncio.gather(*(self.connect(first_client + x, limit, context) for x in range(count)))
+        connection_time = time.monotonic() - connection_time_start
+        self.clients = [protocol for protocol in protocols if protocol is not None]
+        # Every process starts sending at the same time.
+        if barrier is not None:
+            await loop.run_in_executor(None, barrier.wait)
+        self.start_time = time.monotonic()
+        end = self.start_time + duration
+        self.sending = True
+        self.active = len(self.clients)
+        if mode == 'open':
+            await self.send_open_loop(rate, end)
+            self.sending = False
+            if self.in_flight:
+                try:
+                    await asyncio.wait_for(self.all_done.wait(), DRAIN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+            self.all_done.set()
+            self.transmission_times = [duration] * len(self.clients)
+        elif self.clients:
+            for client in self.clients:
+                for x in range(depth):
+                    client.send_request(self.start_time)
+            stopper = None
+            timeout = None
+            if num_bytes == 0:
+                stopper = loop.create_task(self.stop_at(end))
+                timeout = duration + DRAIN_TIMEOUT
+            try:
+                await asyncio.wait_for(self.all_done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.all_done.set()
+            if stopper is not None:
+                stopper.cancel()
+        transmission_time = max(self.last_response - self.start_time, 0)
+        unanswered = sum(len(client.due_times) for client in self.clients)
+        bytes_sent = sum(client.bytes_sent for client in self.clients)
+        for client in self.clients:
+            client.transport.close()
+        # Let the transports finish closing before the event loop is closed.
+        await asyncio.sleep(0)
+        return {
+            'clients': len(self.clients),
+            'unable_to_connect': self.unable_to_connect,
+            'disconnected': self.disconnected,
+            'connection_time': connection_time,
+            'transmission_time': transmission_time,
+            'bytes_sent': bytes_sent,
+            'requests': self.requests,
+            'responses': self.responses,
+            'unanswered': unanswered,
+            'response_time_sum': self.response_time_sum,
+            'transmission_times': self.transmission_times,
+            'histogram': self.histogram,
+            'responses_per_second': self.responses_per_second,
+        }
+
+
+# This function runs the clients of one process and returns their statistics.
+def run_process(first_client, count, process_rate, barrier):
+    return asyncio.run(LoadGenerator().run(first_client, count, process_rate, barrier))
+
+
+def worker_process(first_client, count, process_rate, barrier, results):
+    results.put(run_process(first_client, count, process_rate, barrier))
+
+
+print(f"Creating {num_clients} client connections to {server} in {num_processes} process(es)...")
+if num_processes == 1:
+    process_results = [run_process(0, num_clients, rate, None)]
+else:
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(num_processes)
+    results = context.Queue()
+    process_list = []
+    first_client = 0
+    for x in range(num_processes):
+        count = num_clients // num_processes + (1 if x < num_clients % num_processes else 0)
+        process_list.append(context.Process(target=worker_process,
+                                            args=(first_client, count, rate / num_processes, barrier, results)))
+        first_client += count
+    for process in process_list:
+        process.start()
+    process_results = [results.get() for process in process_list]
+    for process in process_list:
+        process.join()
+
+connected = sum(result['clients'] for result in process_results)
+connection_time = max(result['connection_time'] for result in process_results)
+transmission_time = max(result['transmission_time'] for result in process_results)
+total_bytes_sent = sum(result['bytes_sent'] for result in process_results)
+total_requests = sum(result['requests'] for result in process_results)
+total_responses = sum(result['responses'] for result in process_results)
+avg_bytes_sent = total_bytes_sent / connected if connected else 0
+avg_requests = total_requests / connected if connected else 0
+avg_response_time_of_clients = sum(result['response_time_sum'] for result in process_results) / total_responses \
+    if total_responses else -1
+avg_connection_time = calc_avg([value for result in process_results for value in result['transmission_times']])
+responses_per_second = total_responses / transmission_time if transmission_time else 0
+histogram = LatencyHistogram()
+time_series = array.array('Q')
+for result in process_results:
+    histogram.merge(result['histogram'])
+    for second, count in enumerate(result['responses_per_second']):
+        while len(time_series) <= second:
+            time_series.append(0)
+        time_series[second] += count
+percentiles = [histogram.percentile(fraction) for fraction in (0.5, 0.9, 0.99, 0.999)]
+
+print(f"{connected} clients finished, "
+      f"{sum(result['unable_to_connect'] for result in process_results)} unable to connect, "
+      f"{sum(result['disconnected'] for result in process_results)} disconnected early.")
 print(f"Statistics:\n\t"
-      f"Total time to connect {len(sock_list)} clients to server: {format(connection_time, '0.4f')} seconds.\n\t"
-      f"Total transmission time for {len(sock_list)} clients: {format(transmission_time, '0.4f')} seconds.\n\t"
+      f"Total time to connect {connected} clients to server: {format(connection_time, '0.4f')} seconds.\n\t"
+      f"Total transmission time for {connected} clients: {format(transmission_time, '0.4f')} seconds.\n\t"
       f"Total bytes sent to server: {total_bytes_sent}.\n\t"
       f"Each client sent an average of {int(avg_bytes_sent)} bytes to the server.\n\t"
       f"Each client sent an average of {int(avg_requests)} requests to the server.\n\t"
+      f"Responses received: {total_responses}, {format(responses_per_second, '0.1f')} per second, "
+      f"{sum(result['unanswered'] for result in process_results)} requests unanswered.\n\t"
       f"The average response time to each client packet: {format(avg_response_time_of_clients, '0.4f')} seconds.\n\t"
-      f"Each individual client transmission took {format(avg_connection_time, '0.4f')} seconds on average.")
+      f"Each individual client transmission took {format(avg_connection_time, '0.4f')} seconds on average.\n\t"
+      f"Response time percentiles: p50 {percentiles[0]}us, p90 {percentiles[1]}us, p99 {percentiles[2]}us, "
+      f"p99.9 {percentiles[3]}us, max {histogram.max}us.\n\t"
+      f"Responses received in each second: {' '.join(str(count) for count in time_series)}")
 
 if LOG:
     if exists('./client_log.txt'):
@@ -205,3 +516,29 @@ if LOG:
             log.write(f"connection_time total_trans_time total_bytes avg_bytes avg_requests avg_response indv_trans_time\n")
             log.write(
                 f"{format(connection_time, '0.4f')} {format(transmission_time, '0.4f')} {total_bytes_sent} {int(avg_bytes_sent)} {int(avg_requests)} {format(avg_response_time_of_clients, '0.4f')} {format(avg_connection_time, '0.4f')}\n")
+    # The percentiles are logged separately so that the columns of client_log.txt stay the same.
+    if not exists('./client_latency_log.txt'):
+        with open('./client_latency_log.txt', 'a', encoding='utf-8') as log:
+            log.write(f"responses responses_per_sec p50_us p90_us p99_us p999_us max_us\n")
+    with open('./client_latency_log.txt', 'a', encoding='utf-8') as log:
+        log.write(f"{total_responses} {format(responses_per_second, '0.1f')} {percentiles[0]} {percentiles[1]} "
+                  f"{percentiles[2]} {percentiles[3]} {histogram.max}\n")
+    parameters = {'connections': num_clients, 'payload': message_size, 'mode': mode, 'depth': depth,
+                  'duration': duration, 'bytes': num_bytes, 'processes': num_processes, 'tls': TLS}
+    if mode == 'open':
+        parameters['rate'] = rate
+    statistics = {
+        'responses': total_responses,
+        'per_second': responses_per_second,
+        'connect_time_us': int(connection_time * 1000000),
+        'p50_us': percentiles[0],
+        'p90_us': percentiles[1],
+        'p99_us': percentiles[2],
+        'p999_us': percentiles[3],
+        'max_us': histogram.max,
+        'errors': sum(result['unable_to_connect'] + result['disconnected'] for result in process_results),
+        'responses_per_second': list(time_series),
+    }
+    record = results_store.make_record(results_store.describe_run('client', vars(args)), args.name,
+                                       f"client-{mode}", parameters, statistics)
+    results_store.append_records(args.output, [record])
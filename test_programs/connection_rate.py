@@ -0,0 +1,68 @@
+import argparse
+import socket
+import sys
+import threading
+import time
+
+# Command Line Argument Parsing
+parser = argparse.ArgumentParser()
+parser.add_argument("-s", "--server", dest="server", help="Server IP address", required=True)
+parser.add_argument("-p", "--port", dest="port", help="Server port number", required=True)
+parser.add_argument("-c", "--connections", dest="connections", default=10000,
+                    help="Total number of connections to open. Default value is 10000.", required=False)
+parser.add_argument("-t", "--threads", dest="threads", default=8,
+                    help="Number of threads opening connections at the same time. Default value is 8.", required=False)
+args = parser.parse_args()
+
+# Check that the numeric arguments are integers.
+try:
+    port = int(args.port)
+    num_connections = int(args.connections)
+    num_threads = int(args.threads)
+except ValueError:
+    print(f"Invalid Argument Type: -p, -c and -t flags expect Integers. Use -h for list of accepted arguments.")
+    sys.exit(0)
+
+server = (args.server, port)
+lock = threading.Lock()
+completed = 0
+failed = 0
+
+
+# Each thread repeatedly connects, sends one message, waits for the echo and closes the connection.
+# A connection only counts once the echo has come back through the port forwarder.
+def connect_func(count):
+    global completed, failed
+    done = 0
+    errors = 0
+    for x in range(count):
+        try:
+            with socket.create_connection(server, timeout=10) as sock:
+                sock.sendall(b'ping')
+                if sock.recv(1024):
+                    done += 1
+                else:
+                    errors += 1
+        except OSError:
+            errors += 1
+    with lock:
+        completed += done
+        failed += errors
+
+
+thread_list = []
+for x in range(num_threads):
+    count = num_connections // num_threads + (1 if x < num_connections % num_threads else 0)
+    thread_list.append(threading.Thread(target=connect_func, args=(count,)))
+start_time = time.time()
+for thread in thread_list:
+    thread.start()
+for thread in thread_list:
+    thread.join()
+elapsed = time.time() - start_time
+
+print(f"Statistics:\n\t"
+      f"Completed connections: {completed}\n\t"
+      f"Failed connections: {failed}\n\t"
+      f"Total time: {format(elapsed, '0.4f')} seconds.\n\t"
+      f"Connections per second: {format(completed / elapsed, '0.1f')}")
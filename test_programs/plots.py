@@ -1,40 +1,204 @@
-from matplotlib import pyplot as plt
-
-# Number of clients for each test.
-num_clients = [2000, 4000, 6000, 8000]
-
-# Average response time Machine 198
-avg_response = [0.1811, 0.3086, 1.7899, 2.8386]
-plt.plot(num_clients, avg_response, '--')
-plt.plot(num_clients, avg_response, 'ro')
-plt.title("Machine 198: Average Response Time")
-plt.xlabel("Number of client connections")
-plt.ylabel("Response Time (seconds)")
-plt.show()
-
-# Average client transmission time Machine 198
-avg_client_transmission = [8.8725, 15.1240, 87.7073, 139.0925]
-plt.plot(num_clients, avg_client_transmission, '--')
-plt.plot(num_clients, avg_client_transmission, 'ro')
-plt.title("Machine 198: Average Client Transmission Time")
-plt.xlabel("Number of client connections")
-plt.ylabel("Average Client Transmission Time (seconds)")
-plt.show()
-
-# Total transmission time Machine 198
-total_transmission = [9.3228, 15.6219, 95.1074, 155.6741]
-plt.plot(num_clients, total_transmission, '--')
-plt.plot(num_clients, total_transmission, 'ro')
-plt.title("Machine 198: Total Transmission Time")
-plt.xlabel("Number of client connections")
-plt.ylabel("Total Transmission Time (seconds)")
-plt.show()
-
-# Total connection time Machine 198
-total_connection = [10.2810, 17.8663, 28.1834, 37.4649]
-plt.plot(num_clients, total_connection, '--')
-plt.plot(num_clients, total_connection, 'ro')
-plt.title("Machine 198: Total Connection Time")
-plt.xlabel("Number of client connections")
-plt.ylabel("Total Connection Time (seconds)")
-plt.show()
+import argparse
+import os
+import sys
+import results_store
+
+# Report generator for the results store written by benchmark.py and client.py. Every metric is plotted
+# against the number of connections, with one line per commit or per run, and the latest commit or run is
+# compared with the latest earlier one which measured the same to flag regressions. Exits with status 1 if
+# a regression was found, so it can be used to fail a build.
+
+# Command Line Argument Parsing
+parser = argparse.ArgumentParser()
+parser.add_argument("-i", "--input", dest="input", default=results_store.DEFAULT_STORE,
+                    help=f"Results store to read. Default is {results_store.DEFAULT_STORE}.", required=False)
+parser.add_argument("-m", "--metrics", dest="metrics", default="gigabytes_per_second,per_second,p99_us",
+                    help="Comma separated results to plot and compare. Default is gigabytes_per_second,per_second,p99_us.",
+                    required=False)
+parser.add_argument("-o", "--output", dest="output", default="plots",
+                    help="Directory the plots are saved to. Default is plots.", required=False)
+parser.add_argument("-g", "--group-by", dest="group_by", default="commit",
+                    help="Acceptable values: commit or run. Measurements of the same group are averaged and drawn "
+                         "as one line. Default is commit.", required=False)
+parser.add_argument("-t", "--threshold", dest="threshold", default=10,
+                    help="Percentage by which a metric has to get worse to be flagged as a regression. "
+                         "Default value is 10.", required=False)
+parser.add_argument("-b", "--baseline", dest="baseline", default=None,
+                    help="Commit or run id, or a prefix of it, to compare against. Default is the latest one "
+                         "before the candidate with results to compare.", required=False)
+parser.add_argument("-c", "--candidate", dest="candidate", default=None,
+                    help="Commit or run id, or a prefix of it, to check for regressions. Default is the latest group.",
+                    required=False)
+parser.add_argument("-e", "--engines", dest="engines", default=None,
+                    help="Comma separated engines to report on. Default is every engine in the store.", required=False)
+args = parser.parse_args()
+
+if args.group_by not in ('commit', 'run'):
+    print(f"Invalid Argument Type: -g flag expects commit or run. Use -h for list of accepted arguments.")
+    sys.exit(0)
+try:
+    threshold = float(args.threshold)
+except ValueError:
+    print(f"Invalid Argument Type: -t flag expects a number. Use -h for list of accepted arguments.")
+    sys.exit(0)
+if not os.path.exists(args.input):
+    print(f"Results store {args.input} does not exist. Run benchmark.py or client.py -l 1 first.")
+    sys.exit(0)
+metrics = args.metrics.split(',')
+engines = args.engines.split(',') if args.engines else None
+
+# Parameters which are not part of what identifies a measurement. The connections are the x axis of the
+# plots, and the duration does not change what is measured.
+IGNORED_PARAMETERS = ('connections', 'duration')
+
+
+# This function returns the group a record belongs to.
+def group_of(record):
+    if args.group_by == 'run':
+        return record['run']['id']
+    return record['run']['commit'] or 'unknown'
+
+
+# This function returns what identifies a measurement apart from its connections, as
+# (engine, test, ((parameter, value), ...)).
+def measurement_of(record):
+    parameters = tuple(sorted((name, value) for name, value in record['parameters'].items()
+                              if name not in IGNORED_PARAMETERS))
+    return record['engine'], record['test'], parameters
+
+
+# This function returns the name of a group as it is printed, commits are shortened like git does.
+def group_label(group):
+    return group[:10] if args.group_by == 'commit' else group
+
+
+def describe_measurement(measurement):
+    engine, test, parameters = measurement
+    return f"{engine} {test} " + ' '.join(f"{name}={value}" for name, value in parameters)
+
+
+# This function averages the records of each group where:
+#   returned value = {group: {(measurement, metric): {connections: value}}}, and the groups in the order
+#   they first appear in the store.
+def collect_values(records):
+    sums = {}
+    order = []
+    for record in records:
+        if engines is not None and record['engine'] not in engines:
+            continue
+        group = group_of(record)
+        if group not in sums:
+            sums[group] = {}
+            order.append(group)
+        for metric in metrics:
+            value = record['results'].get(metric)
+            if not isinstance(value, (int, float)) or metric in results_store.IGNORED_RESULTS:
+                continue
+            points = sums[group].setdefault((measurement_of(record), metric), {})
+            total, count = points.get(record['parameters']['connections'], (0, 0))
+            points[record['parameters']['connections']] = (total + value, count + 1)
+    values = {}
+    for group in sums:
+        values[group] = {}
+        for key, points in sums[group].items():
+            values[group][key] = {connections: total / count for connections, (total, count) in points.items()}
+    return values, order
+
+
+# This function returns the group matching the given id or prefix, and exits if there is none.
+def find_group(order, name):
+    matches = [group for group in order if group.startswith(name)]
+    if len(matches) != 1:
+        print(f"{name} matches {len(matches)} {args.group_by}s in {args.input}, it has to match exactly one.")
+        sys.exit(0)
+    return matches[0]
+
+
+def file_name(measurement, metric):
+    engine, test, parameters = measurement
+    parts = [test, engine] + [f"{name}{value}" for name, value in parameters] + [metric]
+    return ''.join(char if char.isalnum() or char in '-.' else '_' for char in '_'.join(parts)) + '.png'
+
+
+# This function saves one plot for every measurement and metric, with a line for each group. Returns the
+# number of plots saved.
+def plot_values(values, order):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, no plots are drawn.")
+        return 0
+    os.makedirs(args.output, exist_ok=True)
+    keys = []
+    for group in order:
+        keys += [key for key in values[group] if key not in keys]
+    for measurement, metric in keys:
+        figure = plt.figure()
+        connection_counts = set()
+        for group in order:
+            points = values[group].get((measurement, metric))
+            if not points:
+                continue
+            connections = sorted(points)
+            connection_counts.update(connections)
+            plt.plot(connections, [points[count] for count in connections], 'o--', label=group_label(group))
+        if max(connection_counts) >= 10 * min(connection_counts):
+            plt.xscale('log')
+        plt.title(f"{describe_measurement(measurement)}: {metric}")
+        plt.xlabel("Number of client connections")
+        plt.ylabel(metric)
+        plt.legend()
+        figure.savefig(os.path.join(args.output, file_name(measurement, metric)))
+        plt.close(figure)
+    return len(keys)
+
+
+# This function compares every value of the candidate group with the same value of the baseline group,
+# and returns the number of values compared and a list of the ones which got worse by more than the
+# threshold as (measurement, metric, connections, baseline value, candidate value, change in percent).
+def find_regressions(values, baseline, candidate):
+    compared = 0
+    regressions = []
+    for (measurement, metric), points in values[candidate].items():
+        baseline_points = values[baseline].get((measurement, metric), {})
+        for connections, value in sorted(points.items()):
+            old_value = baseline_points.get(connections)
+            if not old_value:
+                continue
+            compared += 1
+            change = (value - old_value) / old_value * 100
+            worse = change if results_store.lower_is_better(metric) else -change
+            if worse > threshold:
+                regressions.append((measurement, metric, connections, old_value, value, change))
+    return compared, regressions
+
+
+records = results_store.load_records(args.input)
+values, order = collect_values(records)
+if not order:
+    print(f"No results for the selected engines in {args.input}.")
+    sys.exit(0)
+print(f"{len(records)} records of {len(order)} {args.group_by}(s) read from {args.input}.")
+print(f"{plot_values(values, order)} plots saved to {args.output}.")
+
+candidate = find_group(order, args.candidate) if args.candidate else order[-1]
+if args.baseline:
+    baseline = find_group(order, args.baseline)
+else:
+    # Runs of different tools or engines can be in between, so look for the latest group which measured
+    # something the candidate measured too.
+    earlier = [group for group in order[:order.index(candidate)] if values[group].keys() & values[candidate].keys()]
+    if not earlier:
+        print(f"Nothing before {group_label(candidate)} measured the same as it, there is nothing to compare.")
+        sys.exit(0)
+    baseline = earlier[-1]
+compared, regressions = find_regressions(values, baseline, candidate)
+print(f"Compared {compared} values of {group_label(candidate)} with {group_label(baseline)}, "
+      f"{len(regressions)} got worse by more than {threshold}%.")
+for measurement, metric, connections, old_value, value, change in regressions:
+    print(f"\tREGRESSION {describe_measurement(measurement)} connections={connections} {metric}: "
+          f"{old_value:.4g} -> {value:.4g} ({change:+.1f}%)")
+if regressions:
+    sys.exit(1)
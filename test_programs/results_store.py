@@ -0,0 +1,79 @@
+import json
+import os
+import platform
+import subprocess
+import time
+
+# Results store shared by benchmark.py, client.py and plots.py. The store is a file with one JSON record
+# per line, so runs are only ever appended and several tools can write to the same store. Every record is
+# one measurement:
+#   run:        metadata of the run the measurement belongs to, the same for every record of a run.
+#   engine:     name of the forwarder or server which was measured.
+#   test:       name of the test.
+#   parameters: settings of the measurement, at least connections and payload.
+#   results:    measured values. Names ending in _us are times in microseconds where lower is better,
+#               every other number is a rate or count where higher is better, except errors.
+
+DEFAULT_STORE = 'benchmark_results.jsonl'
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Results which are not compared between runs.
+IGNORED_RESULTS = ('errors', 'completed', 'bytes', 'responses')
+
+
+# This function returns the git revision of the repository, or None if it is not known.
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# This function returns the metadata of a run, with the command line arguments it was started with.
+def describe_run(tool, arguments):
+    started = time.time()
+    commit = git_revision()
+    return {
+        'id': f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(started))}-{os.getpid()}",
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(started)),
+        'tool': tool,
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'commit': commit,
+        'arguments': arguments,
+    }
+
+
+def make_record(run, engine, test, parameters, results):
+    return {'run': run, 'engine': engine, 'test': test, 'parameters': parameters, 'results': results}
+
+
+def append_records(path, records):
+    with open(path, 'a', encoding='utf-8') as store:
+        for record in records:
+            store.write(json.dumps(record) + '\n')
+
+
+# This function returns the records of the store in the order they were written. Lines which are not
+# complete records, for example the last line of a run which was killed while writing, are skipped.
+def load_records(path):
+    records = []
+    with open(path, encoding='utf-8') as store:
+        for line in store:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and all(key in record for key in ('run', 'engine', 'test', 'parameters',
+                                                                          'results')):
+                records.append(record)
+    return records
+
+
+# This function returns True if a lower value of the result is better.
+def lower_is_better(name):
+    return name.endswith('_us')
@@ -6,60 +6,105 @@ import signal
 from contextlib import contextmanager
 import socket
 from select import epoll
-from multiprocessing import Process, Pipe
 
 
 class Server:
 
     BUFF_SIZE = 1024
+    MAX_FDS = 64
+    # Seconds a client has to finish the TLS handshake.
+    HANDSHAKE_TIMEOUT = 5
 
     def __init__(self):
-        self.epoll = epoll()
+        self.epoll = None
         self.client_sd_list = {}
         self.client_msg_list = {}
         self.server_msg_list = {}
         self.request_count_list = {}
         self.data_sent = {}
-        self.pipe = None
+        self.channel = None
+        self.clients_received = 0
+        self.load_changed = False
         # Create SSL context
         self.context = ssl.SSLContext()
         self.context.load_cert_chain('./server.cert', './server_priv.key')
         self.context.load_verify_locations(capath='./cacert.pem')
 
-    # The main method of the server object.
-    def start_server(self, pipe):
+    # The main method of the server object. Client sockets are received as file descriptors over the unix
+    # socket channel from the main process, and the number of clients received and still connected is
+    # reported back over the same channel whenever it changes so the main process can pick the least loaded
+    # worker.
+    def start_server(self, channel):
         try:
-            self.pipe = pipe
+            self.channel = channel
+            self.channel.setblocking(0)
+            # The epoll object is created in the worker process, so it is not shared with the main process.
+            self.epoll = epoll()
+            self.epoll.register(self.channel.fileno(), select.EPOLLIN)
             while True:
-                while self.pipe.poll():
-                    try:
-                        conn = self.pipe.recv()
-                        # conn = socket.fromfd(sd, family=socket.AF_INET, type=socket.SOCK_STREAM)
-                        conn = self.context.wrap_socket(conn, do_handshake_on_connect=True, server_side=True)
-                    except RuntimeError:
-                        continue
-                    sd = conn.fileno()
-                    self.epoll.register(sd, select.EPOLLIN)
-                    self.request_count_list[sd] = 0
-                    self.data_sent[sd] = 0
-                    self.client_sd_list[sd] = conn
-                    self.client_msg_list[sd] = ''
-                    self.server_msg_list[sd] = ''
-                    print(f"PID:{os.getpid()} Registered client socket descriptor {sd}.")
-
                 events = self.epoll.poll(1)
 
                 if len(events) == 0:
                     continue
                 for sd, event in events:
+                    if sd == self.channel.fileno():
+                        if not self.receive_clients():
+                            return
+                        continue
+                    if sd not in self.client_sd_list:
+                        continue
                     if event & select.EPOLLIN:
                         self.read_msg(sd)
                     if event & select.EPOLLOUT:
                         self.data_sent[sd] += self.send_msg(sd)
+                if self.load_changed:
+                    self.report_load()
 
         except KeyboardInterrupt:
             self.close_connections()
 
+    # This method receives the client sockets waiting in the channel and registers them. Returns False if
+    # the main process closed the channel.
+    def receive_clients(self):
+        while True:
+            try:
+                msg, fds, flags, addr = socket.recv_fds(self.channel, 16, self.MAX_FDS)
+            except BlockingIOError:
+                return True
+            if not msg:
+                return False
+            for fd in fds:
+                self.clients_received += 1
+                self.load_changed = True
+                conn = socket.socket(fileno=fd)
+                try:
+                    # The descriptor keeps the flags it was accepted with. The handshake is done blocking, with a
+                    # timeout so a client which never sends its hello can't stall the worker.
+                    conn.settimeout(self.HANDSHAKE_TIMEOUT)
+                    conn = self.context.wrap_socket(conn, do_handshake_on_connect=True, server_side=True)
+                except (OSError, RuntimeError):
+                    conn.close()
+                    continue
+                # The client is read from when epoll reports it, so reading must not block the other clients.
+                conn.setblocking(False)
+                sd = conn.fileno()
+                self.epoll.register(sd, select.EPOLLIN)
+                self.request_count_list[sd] = 0
+                self.data_sent[sd] = 0
+                self.client_sd_list[sd] = conn
+                self.client_msg_list[sd] = ''
+                self.server_msg_list[sd] = ''
+                print(f"PID:{os.getpid()} Registered client socket descriptor {sd}.")
+
+    # This method sends the number of clients received and the number still connected to the main process.
+    # If the channel is full the report is sent again after the next events.
+    def report_load(self):
+        try:
+            self.channel.send(f"L {self.clients_received} {len(self.client_sd_list)}".encode("utf-8"))
+            self.load_changed = False
+        except BlockingIOError:
+            pass
+
     # Closes all connections in the client connection list.
     def close_connections(self):
         print(f"\nProcess PID: {os.getpid()} closing all connections.")
@@ -70,9 +115,14 @@ class Server:
 
     def generate_statistics(self):
         total_data_sent = self.calc_sum(self.data_sent)
-        average_data_sent = total_data_sent / len(self.data_sent)
-        average_num_requests = self.calc_average(self.request_count_list)
-        self.pipe.send((total_data_sent, average_data_sent, average_num_requests))
+        if len(self.data_sent) == 0:
+            average_data_sent = 0
+            average_num_requests = 0
+        else:
+            average_data_sent = total_data_sent / len(self.data_sent)
+            average_num_requests = self.calc_average(self.request_count_list)
+        self.channel.setblocking(1)
+        self.channel.send(f"S {total_data_sent} {average_data_sent} {average_num_requests}".encode("utf-8"))
 
     def calc_sum(self, dictionary):
         sum = 0
@@ -98,6 +148,9 @@ class Server:
         try:
             # Read the client message and place into client msg dict.
             self.client_msg_list[sd] = self.client_sd_list[sd].recv(self.BUFF_SIZE).decode("utf-8")
+        except ssl.SSLWantReadError:
+            # Only part of a TLS record has arrived, the rest is read when epoll reports it.
+            return
         except ConnectionResetError:
             pass
         # If we receive an empty string or quit then the client is closing the connection.
@@ -109,6 +162,7 @@ class Server:
             self.client_sd_list[sd].close()
             # Remove sd from all dictionaries.
             del self.client_sd_list[sd], self.client_msg_list[sd], self.server_msg_list[sd]
+            self.load_changed = True
         else:
             # Change the client sd from read to write mode for next iteration.
             self.epoll.modify(sd, select.EPOLLOUT)
@@ -1,12 +1,9 @@
-import pickle
 from contextlib import contextmanager
 import socket
 import select
-import ssl
-import copyreg
 import argparse
 import sys
-from multiprocessing import Process, Pipe
+import multiprocessing
 from server import Server
 from os.path import exists
 
@@ -14,9 +11,10 @@ from os.path import exists
 parser = argparse.ArgumentParser()
 parser.add_argument("-s", "--server", dest="server", help="Server IP")
 parser.add_argument("-p", "--port", dest="port", help="Server port number to listen on")
-parser.add_argument("-m", "--multiprocess", dest="multiprocess", required=False, default=0, help="If this flag is present then the epoll server is run in multiprocessing mode. It expects an integer, representing the number"
-                                                                                                 "of clients each process can maximally handle. I.e. -m 1000 means multiprocessing mode and create a process for every 1000 client"
-                                                                                                 "connections.")
+parser.add_argument("-m", "--multiprocess", dest="multiprocess", required=False, default=0, help="If this flag is present then the epoll server is run in multiprocessing mode. It expects an integer, representing the number "
+                                                                                                 "of clients each process can maximally handle, clients accepted when every process is full are closed. I.e. -m 1000 means "
+                                                                                                 "multiprocessing mode and every process handles up to 1000 client connections.")
+parser.add_argument("-w", "--workers", dest="workers", default=None, help="Number of worker processes, all are started up front and every client is passed to the one handling the fewest clients. Default value is 1, or 10 in multiprocessing mode.", required=False)
 parser.add_argument("-l", "--log", dest="log", default=0, help="Acceptable values: 0 or 1. If 1 then the statistics will be logged to a file. Default value is 0 meaning do not log.", required=False)
 args = parser.parse_args()
 
@@ -77,6 +75,99 @@ else:
         print(f"Invalid Argument Type: -m flag expects an Integer. Use -h for list of accepted arguments.")
         sys.exit(0)
 
+# Check that the number of workers is an integer, one worker is used unless in multiprocessing mode.
+if args.workers is None:
+    WORKERS = 1 if args.multiprocess == 0 else 10
+else:
+    try:
+        WORKERS = int(args.workers)
+    except ValueError:
+        print(f"Invalid Argument Type: -w flag expects an Integer. Use -h for list of accepted arguments.")
+        sys.exit(0)
+    if WORKERS < 1:
+        print(f"Invalid Argument Type: -w flag expects an Integer greater than 0. Use -h for list of accepted arguments.")
+        sys.exit(0)
+
+# Worker Variables
+# Every worker has a unix socket channel to the main process. Accepted client sockets are passed to the
+# worker as file descriptors with SCM_RIGHTS, and the worker reports how many it received and how many are
+# still connected. The load of a worker is the number still connected plus the number sent which it has not
+# reported yet, so clients accepted in a burst are spread before the reports arrive.
+process_list = []
+channel_list = []
+channel_workers = {}
+clients_sent = []
+clients_received = []
+clients_connected = []
+# False once the channel of the worker has been closed by the worker exiting.
+worker_alive = []
+
+
+# This function returns the number of clients a worker is handling.
+def worker_load(worker):
+    return clients_connected[worker] + clients_sent[worker] - clients_received[worker]
+
+
+# This function starts every worker process with a channel to it.
+def start_workers():
+    context = multiprocessing.get_context('fork')
+    for x in range(0, WORKERS):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        s = Server()
+        p = context.Process(target=s.start_server, args=(child,))
+        p.start()
+        child.close()
+        parent.setblocking(0)
+        process_list.append(p)
+        channel_list.append(parent)
+        channel_workers[parent.fileno()] = x
+        clients_sent.append(0)
+        clients_received.append(0)
+        clients_connected.append(0)
+        worker_alive.append(True)
+
+
+# This function sends an accepted client to the least loaded worker which is still running. The client is
+# closed if every worker already handles the maximum number of clients per process or has exited.
+def dispatch_client(conn, addr):
+    workers = [x for x in range(0, WORKERS) if worker_alive[x]]
+    if not workers:
+        print(f"Every process has exited, closing client {addr}")
+        conn.close()
+        return
+    worker = min(workers, key=worker_load)
+    if worker_load(worker) >= NUM_CLIENTS_PER_PROCESS:
+        print(f"Every process is handling {NUM_CLIENTS_PER_PROCESS} clients, closing client {addr}")
+        conn.close()
+        return
+    try:
+        socket.send_fds(channel_list[worker], [b'C'], [conn.fileno()])
+        clients_sent[worker] += 1
+    except OSError as e:
+        print(f"Unable to pass client {addr} to process {process_list[worker].pid}: {e}")
+    # The worker has its own descriptor of the client now.
+    conn.close()
+
+
+# This function reads the messages a worker sent on its channel. Load reports update the load of the
+# worker, and the statistics are returned once they are read, otherwise None is returned. The worker is
+# marked as exited when its channel is closed.
+def read_channel(worker):
+    while True:
+        try:
+            msg = channel_list[worker].recv(BUFF_SIZE)
+        except BlockingIOError:
+            return None
+        if not msg:
+            worker_alive[worker] = False
+            return None
+        fields = msg.decode("utf-8").split()
+        if fields[0] == 'L':
+            clients_received[worker] = int(fields[1])
+            clients_connected[worker] = int(fields[2])
+        elif fields[0] == 'S':
+            return int(fields[1]), float(fields[2]), float(fields[3])
+
 
 # This is the main server function which takes the server address as arguments.
 # address should be a tuple in the form (string, int) --> (ip, port)
@@ -90,58 +181,52 @@ def main_process(address):
             print(f"Listening on {address}...")
             server.setblocking(0)
             server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            #Create SSL context
-            context = ssl.SSLContext()
-            context.load_cert_chain('./server.cert', './server_priv.key')
-            context.load_verify_locations(capath='./cacert.pem')
-            #Wrap socket in context.
-            # server = context.wrap_socket(sock=server, server_side=True)
             server_sd = server.fileno()
-            # Process and Pipe List
-            process_list = []
-            pipe_list = []
-
-            # Pre-allocating 10 processes which will be able to handle many clients each in parallel.
-            for x in range(0, 10):
-                s = Server()
-                parent, child = Pipe()
-                p = Process(target=s.start_server, args=(child,))
-                process_list.append(p)
-                pipe_list.append(parent)
-            num_clients = 0
-            num_processes = 0
-
-            # Check for new connections.
+
+            # Starting every worker up front, so no client waits for a process to start.
+            start_workers()
+            for channel in channel_list:
+                epoll.register(channel.fileno(), select.EPOLLIN)
+
+            # Check for new connections and load reports.
             while True:
                 events = epoll.poll(1)
                 for sd, event in events:
                     if sd == server_sd:
-                        conn, addr = server.accept()
-                        conn.setblocking(0)
-                        print("Listening Socket --> Client connected: ", addr)
-                        if num_clients != 0:
-                            if num_clients % NUM_CLIENTS_PER_PROCESS != 0:
-                                pipe_list[num_processes].send(conn)
-                            if num_clients % NUM_CLIENTS_PER_PROCESS == 0:
-                                num_processes = num_processes + 1
-                                process_list[num_processes].start()
-                                pipe_list[num_processes].send(conn)
-                        if num_clients == 0:
-                            process_list[num_processes].start()
-                            pipe_list[num_processes].send(conn)
-                        num_clients = num_clients + 1
+                        while True:
+                            try:
+                                conn, addr = server.accept()
+                            except BlockingIOError:
+                                break
+                            print("Listening Socket --> Client connected: ", addr)
+                            dispatch_client(conn, addr)
+                    elif sd in channel_workers:
+                        worker = channel_workers[sd]
+                        read_channel(worker)
+                        if not worker_alive[worker]:
+                            # The channel of an exited worker stays readable, so it is no longer polled.
+                            print(f"Process {process_list[worker].pid} has exited, no more clients are passed to it")
+                            epoll.unregister(sd)
+                            del channel_workers[sd]
+                            channel_list[worker].close()
     except KeyboardInterrupt:
         process_data = []
+        for worker in range(0, len(channel_list)):
+            if channel_list[worker].fileno() == -1:
+                continue
+            channel_list[worker].setblocking(1)
+            data = read_channel(worker)
+            # Workers which never had a client have no statistics to add.
+            if data is not None and clients_sent[worker] > 0:
+                process_data.append(data)
         for process in process_list:
             if process.is_alive():
                 process.join()
-        if num_processes == 0:
-            data = pipe_list[num_processes].recv()
-            generate_single_process_statistics(data)
+        if len(process_data) == 0:
+            print("No clients connected, there are no statistics.")
+        elif WORKERS == 1:
+            generate_single_process_statistics(process_data[0])
         else:
-            for x in range(0, num_processes+1):
-                data = pipe_list[x].recv()
-                process_data.append(data)
             generate_multiprocess_statistics(process_data)
 
 